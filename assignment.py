@@ -0,0 +1,87 @@
+"""Handle optimal assignment of bank entries to sheet entries."""
+import heapq
+import math
+
+
+def _find_path(start_row, row_edges, penalty, row_potentials, col_potentials, col_rows):
+    """Find the cheapest way to add a row to the assignment (Dijkstra).
+
+    Only the columns the search reaches are looked at, so each step costs about the
+    edges of the rows on the path rather than a scan of every column. Returns the
+    column the path ends at, its distance, the distance of every column settled
+    and the row each column was reached from.
+    """
+    dists = {}
+    settled = {}
+    prev_rows = {}
+    heap = []
+    row, dist = start_row, 0
+    while True:
+        row_potential = row_potentials.get(row, 0)
+        # Every row can be left unpaired through a column of its own
+        for col, cost in [*row_edges[row], (-1 - row, penalty)]:
+            if col in settled:
+                continue
+            col_dist = dist + cost - row_potential - col_potentials.get(col, 0)
+            if col_dist < dists.get(col, math.inf):
+                dists[col] = col_dist
+                prev_rows[col] = row
+                heapq.heappush(heap, (col_dist, col))
+
+        dist, col = heapq.heappop(heap)
+        while col in settled or dist > dists[col]:
+            dist, col = heapq.heappop(heap)
+        settled[col] = dist
+        if col not in col_rows:
+            return col, dist, settled, prev_rows
+        row = col_rows[col]
+
+
+def assign(edges, penalty):
+    """Pair rows with columns to minimize the total cost.
+
+    Rows are added one at a time along the cheapest augmenting path, with
+    potentials keeping the costs seen by the search non-negative, so only the
+    edges near each path are looked at.
+
+    Parameters
+    ----------
+    edges
+        Dict from (row, col) to the cost of pairing them. Missing pairs can't be made.
+        Rows and columns are indices, so not negative.
+    penalty
+        Cost of leaving a row unpaired. Must exceed the cost of every edge.
+
+    Returns a sorted list of (row, col) pairs.
+
+    """
+    row_edges = {}
+    for (row, col), cost in edges.items():
+        row_edges.setdefault(row, []).append((col, cost))
+
+    row_potentials = {}
+    col_potentials = {}
+    row_cols = {}
+    col_rows = {}
+    for start_row in sorted(row_edges):
+        end_col, dist, settled, prev_rows = _find_path(
+            start_row, row_edges, penalty, row_potentials, col_potentials, col_rows
+        )
+
+        # Keep the costs of the edges on every cheapest path at 0
+        row_potentials[start_row] = dist
+        for col, col_dist in settled.items():
+            if col in col_rows:
+                row_potentials[col_rows[col]] += dist - col_dist
+            col_potentials[col] = col_potentials.get(col, 0) - (dist - col_dist)
+
+        # Shift each row on the path to the column it was reached through
+        col = end_col
+        while True:
+            row = prev_rows[col]
+            col_rows[col] = row
+            row_cols[row], col = col, row_cols.get(row)
+            if row == start_row:
+                break
+
+    return sorted((row, col) for row, col in row_cols.items() if col >= 0)
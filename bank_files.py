@@ -0,0 +1,195 @@
+"""Handle reading transactions from files exported by the bank."""
+import csv
+import html
+import os
+import re
+
+from entries import Entry, get_columns
+from formatting import get_converter
+import metrics
+import sheet
+
+EXPORT_DIR = "exports"  # Directory watched for files downloaded from the bank
+CSV_DATE_FORMAT = "%m/%d/%Y"
+OFX_DATE_FORMAT = "%Y%m%d"
+# Names each field may have in the header of a CSV file
+CSV_COLUMNS = {
+    "Transaction Status": ("Status", "Transaction Status"),
+    "Date": ("Date", "Posting Date", "Transaction Date"),
+    "Description": ("Description", "Payee", "Memo"),
+    "Amount": ("Amount",),
+    "Balance": ("Balance", "Running Balance"),
+}
+OFX_ACCOUNTS = {}  # Account names by the ids in OFX files, else taken from file names
+OFX_TAGS = re.compile(r"<(/?)(\w+)>([^<\r\n]*)")
+FIELDS = ("Transaction Status", "Date", "Description", "Amount", "Balance")
+ENTRY_COLUMNS = get_columns(FIELDS + ("account",))
+
+
+def _get_status(status):
+    """Get the status of a transaction as the bank's table shows it."""
+    if status.strip().lower().startswith("pending"):
+        return "Pending transaction"
+    return "Posted transaction"
+
+
+def _get_file_account(path, accounts):
+    """Get the account a file was exported from by its name, or None."""
+    name = os.path.basename(path).lower()
+    for account in accounts:
+        if account.lower() in name:
+            return account
+    return None
+
+
+def _get_csv_columns(header):
+    """Find the column of each field in the header of a CSV file."""
+    columns = {}
+    for field, names in CSV_COLUMNS.items():
+        for name in names:
+            if name in header:
+                columns[field] = header.index(name)
+                break
+    missing = {"Date", "Description", "Amount"} - set(columns)
+    if missing:
+        raise ValueError(f"CSV file has no column for: {', '.join(sorted(missing))}")
+    return columns
+
+
+def _parse_csv(export_file, account):
+    """Parse the rows of a CSV file into transactions, yielding each one."""
+    rows = csv.reader(export_file)
+    header = [name.strip() for name in next(rows, [])]
+    columns = _get_csv_columns(header)
+    to_date = get_converter("Date", CSV_DATE_FORMAT)
+    to_number = get_converter()
+
+    for row in rows:
+        if not any(row):
+            continue
+        values = {
+            field: row[column].strip() if column < len(row) else ""
+            for field, column in columns.items()
+        }
+        balance = values.get("Balance", "")
+        yield Entry(ENTRY_COLUMNS, [
+            _get_status(values.get("Transaction Status", "")),
+            to_date(values["Date"]),
+            values["Description"],
+            to_number(values["Amount"]),
+            to_number(balance) if balance else "",
+            account,
+        ])
+
+
+def _parse_ofx(export_file, account, balances):
+    """Parse the transactions of an OFX or QFX file, yielding each one.
+
+    Works for both the SGML and XML versions of OFX. The balances of each account in
+    the file are added to balances by the name of their tag.
+    """
+    to_date = get_converter("Date", OFX_DATE_FORMAT)
+    to_number = get_converter()
+    transaction = None
+    balance_tag = None
+    for line in export_file:
+        for closing, tag, value in OFX_TAGS.findall(line):
+            value = html.unescape(value.strip())
+            if tag == "ACCTID" and value in OFX_ACCOUNTS:
+                account = OFX_ACCOUNTS[value]
+            elif tag == "STMTTRN":
+                if closing and not isinstance(transaction, type(None)):
+                    yield Entry(ENTRY_COLUMNS, [
+                        "Posted transaction",
+                        to_date(transaction["DTPOSTED"][:8]),
+                        transaction.get("NAME") or transaction.get("MEMO", ""),
+                        to_number(transaction["TRNAMT"]),
+                        "",
+                        account,
+                    ])
+                transaction = None if closing else {}
+            elif tag in ("AVAILBAL", "LEDGERBAL"):
+                balance_tag = None if closing else tag
+            elif tag == "BALAMT" and balance_tag and not closing:
+                balances.setdefault(account, {})[balance_tag] = to_number(value)
+            elif not closing and value and not isinstance(transaction, type(None)):
+                transaction[tag] = value
+
+
+def _count_entries(entries):
+    """Count the transactions in a file which are the same in every field."""
+    counts = {}
+    for entry in entries:
+        key = tuple(entry.get(field) for field in ENTRY_COLUMNS)
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def get_entries(accounts, cutoff=None, directory=None):
+    """Read transactions from every CSV, OFX and QFX file in a directory.
+
+    Each file is from the account in its name, or in OFX_ACCOUNTS for OFX files.
+    Transactions repeated by overlapping exports are only kept once, as many times as
+    they appear in a single file. Transactions before the cutoff date are dropped.
+    The balances in OFX files are added to the sheet. Files which can't be read, or
+    whose account can't be told, are skipped and recorded in their metrics.
+    """
+    if isinstance(directory, type(None)):
+        directory = EXPORT_DIR
+
+    paths = [os.path.join(directory, name) for name in os.listdir(directory)]
+    # Oldest first, so the newest balance of each account is kept
+    paths.sort(key=os.path.getmtime)
+
+    counts = {}
+    balances = {}
+    for path in paths:
+        extension = os.path.splitext(path)[1].lower()
+        if extension not in (".csv", ".ofx", ".qfx"):
+            continue
+
+        with metrics.stage("import file", file=os.path.basename(path)) as record:
+            account = _get_file_account(path, accounts)
+            file_balances = {}
+            skipped = None
+            try:
+                with open(
+                    path, newline="", encoding="utf-8-sig", errors="replace"
+                ) as file:
+                    if extension == ".csv":
+                        entries = _parse_csv(file, account)
+                    else:
+                        entries = _parse_ofx(file, account, file_balances)
+                    file_counts = _count_entries(entries)
+            except (ValueError, KeyError) as error:
+                # Not an export, such as an unrelated or empty file
+                skipped = f"{type(error).__name__}: {error}"
+            else:
+                if any(
+                    key[ENTRY_COLUMNS["account"]] not in accounts for key in file_counts
+                ):
+                    skipped = "Can't tell which account it is from"
+            if skipped:
+                # Left for the user to remove, the other files are still read
+                print(f"SKIPPED {path}: {skipped}")
+                record["skipped"] = skipped
+                continue
+            record["rows"] = sum(file_counts.values())
+
+        for key, count in file_counts.items():
+            counts[key] = max(counts.get(key, 0), count)
+        for file_account, amounts in file_balances.items():
+            # Prefer the available balance, as the bank's website shows
+            balances[file_account] = amounts.get("AVAILBAL", amounts.get("LEDGERBAL"))
+
+    entries = []
+    for key, count in counts.items():
+        if cutoff and key[ENTRY_COLUMNS["Date"]] < cutoff:
+            continue
+        entries.extend(Entry(ENTRY_COLUMNS, list(key)) for _ in range(count))
+
+    for account, balance in balances.items():
+        if account in accounts:
+            sheet.add_bank_balance(balance, account, accounts)
+
+    return entries
@@ -2,18 +2,26 @@
 
 from selenium import webdriver
 from selenium.webdriver.common.keys import Keys
-from selenium.common.exceptions import (ElementNotInteractableException,
+from selenium.common.exceptions import (WebDriverException,
+                                        ElementNotInteractableException,
                                         NoSuchElementException,
                                         UnexpectedAlertPresentException,
                                         ElementNotVisibleException,
+                                        StaleElementReferenceException,
                                         TimeoutException)
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 
-from formatting import format_value
+from entries import Entry, get_columns
+from files import atomic_write
+from formatting import format_value, get_converter
+import metrics
 import sheet
 
+from concurrent.futures import ThreadPoolExecutor
+import os
+import queue
 import time
 import json
 
@@ -21,29 +29,82 @@ BANK_INFO = "bank_info.json"
 DATE_FORMAT = "%b %d, %Y"
 
 HEADLESS = True
+PROFILE_DIR = "chrome_profile"  # Reused so the bank remembers the browser
+COOKIE_FILE = "cookies.json"  # Session cookies kept between runs
+PARALLEL_ACCOUNTS = 1  # Drivers scraping accounts at once, 1 to use only the first
+MORE_BUTTON = "#table--transactions > tfoot > tr:nth-child(1) > td > button"
+TABLE_ROWS = "#table--transactions > tbody > tr"
+EXPAND_TIMEOUT = 10  # Seconds to wait for more transactions to load
+EXPAND_RETRIES = 3  # Times in a row more transactions may fail to load
+STRUCTURED_ROWS = True  # Pull cells of each row instead of parsing table text
+ROW_CELLS = ("Transaction Status", "Date", "Description", "Amount", "Balance")
+ENTRY_COLUMNS = get_columns(ROW_CELLS + ("account",))
+ROWS_SCRIPT = """
+return Array.from(document.querySelectorAll(arguments[0]), row =>
+    Array.from(row.cells, cell => cell.innerText.replace(/\\s+/g, " ").trim()));
+"""
+
+expand_times = {}  # Seconds taken to expand the table of each account
+
+
+def _count_rows(driver):
+    """Count the rows loaded into the transaction table."""
+    return len(driver.find_elements_by_css_selector(TABLE_ROWS))
+
+
+def _get_oldest_date(driver):
+    """Get the date of the last row loaded into the transaction table."""
+    rows = driver.find_elements_by_css_selector(TABLE_ROWS)
+    if not rows:
+        return None
+    _, date = _split_status(rows[-1].text.split("\n")[0])
+    try:
+        return format_value(date, "Date", DATE_FORMAT)
+    except ValueError:
+        # Not a transaction row
+        return None
 
 
-def _expand_table(driver):
-    """Expand the transaction table to its full extent."""
-    # Load all transactions
+def _expand_table(driver, cutoff=None):
+    """Expand the transaction table to its full extent.
 
-    # Select the more transactions button
-    try:
-        more = driver.find_element_by_css_selector(
-            "#table--transactions > tfoot > tr:nth-child(1) > td > button")
-        while True:
-            # Load all transactions
-            time.sleep(1)
+    Stops once transactions older than the cutoff date are loaded. Returns the
+    seconds taken. Raises TimeoutException if the table stops loading before then.
+    """
+    start = time.monotonic()
+    wait = WebDriverWait(driver, EXPAND_TIMEOUT)
+    failures = 0
+
+    # Load all transactions
+    while True:
+        try:
+            buttons = driver.find_elements_by_css_selector(MORE_BUTTON)
+            if not buttons or not buttons[0].is_displayed():
+                # No more transactions
+                break
+            oldest = _get_oldest_date(driver)
+            if cutoff and oldest and oldest < cutoff:
+                # The rest are already in the sheet
+                break
+            rows = _count_rows(driver)
+            more = wait.until(
+                EC.element_to_be_clickable((By.CSS_SELECTOR, MORE_BUTTON)))
             more.click()
-    except (ElementNotInteractableException, ElementNotVisibleException):
-        # No more transactions
-        pass
-    time.sleep(1)
 
-    # Double check to ensure no more transactions
-    lines = _get_table_lines(driver)
-    if "MORE TRANSACTIONS" in lines:
-        _expand_table(driver)
+            # Wait for new rows or for the table to be redrawn
+            wait.until(lambda driver: _count_rows(driver) > rows
+                       or EC.staleness_of(more)(driver))
+            failures = 0
+        except (ElementNotInteractableException, ElementNotVisibleException,
+                StaleElementReferenceException, TimeoutException):
+            # Try again unless the button went away, a partial table would
+            # leave out older transactions
+            failures += 1
+            if failures > EXPAND_RETRIES:
+                raise TimeoutException(
+                    f"Transactions stopped loading after {EXPAND_RETRIES} retries")
+
+    return time.monotonic() - start
 
 
 def _get_groups(values):
@@ -62,18 +123,28 @@ def _get_groups(values):
         yield group
 
 
+def _split_status(line):
+    """Split the first line of a transaction into its status and date."""
+    values = line.split(" ")
+    return " ".join(values[:2]), " ".join(values[2:])
+
+
+def _get_converters():
+    """Get the function which formats values of each field of a transaction."""
+    return {field: get_converter(field, DATE_FORMAT) for field in ROW_CELLS}
+
+
 def _parse_entries(raw_lines):
     """Parse the table pulled from the bank into transactions."""
 
     # First two lines are field names
     entries = []
+    converters = _get_converters()
 
     for group in _get_groups(raw_lines):
         # Refactor date lines onto start of following line and split tabs
-        entry = {}
-        first_values = group[0].split(" ")
-        entry["Transaction Status"] = " ".join(first_values[:2])
-        entry["Date"] = " ".join(first_values[2:])
+        entry = Entry(ENTRY_COLUMNS)
+        entry["Transaction Status"], entry["Date"] = _split_status(group[0])
 
         entry["Description"] = group[1]
         if " " in group[2]:
@@ -83,13 +154,47 @@ def _parse_entries(raw_lines):
             entry["Amount"], entry["Balance"] = group[2], ""
 
         for field in entry:
-            entry[field] = format_value(entry[field], field, DATE_FORMAT)
+            entry[field] = converters[field](entry[field])
 
         entries.append(entry)
 
     return entries
 
 
+def _parse_rows(rows):
+    """Parse rows of cell values pulled from the bank into transactions."""
+    entries = []
+    converters = _get_converters()
+
+    for row in rows:
+        if len(row) != len(ROW_CELLS):
+            raise ValueError(f"Unexpected cells in transaction row: {row}")
+        values = [converters[field](value) for field, value in zip(ROW_CELLS, row)]
+        entries.append(Entry(ENTRY_COLUMNS, values))
+
+    return entries
+
+
+def _get_table_rows(driver):
+    """Pull the cell values of every row in the table with a single script."""
+    return driver.execute_script(ROWS_SCRIPT, TABLE_ROWS)
+
+
+def _get_table_entries(driver):
+    """Pull transactions from the table, falling back to parsing its text."""
+    if STRUCTURED_ROWS:
+        try:
+            entries = _parse_rows(_get_table_rows(driver))
+        except (ValueError, WebDriverException):
+            # Table isn't laid out as expected
+            entries = []
+        if entries:
+            return entries
+
+    # TABLE_ROWS may no longer match the rows even though the table has them
+    return _parse_entries(_get_table_lines(driver))
+
+
 def _get_table_lines(driver):
     """Pull text from table."""
     elem = driver.find_element_by_id("table--transactions")
@@ -98,14 +203,12 @@ def _get_table_lines(driver):
     return raw_lines
 
 
-def _process_accounts(driver, accounts):
-    """Get entries from every account."""
-
-    entries_list = []
-
-    for i in range(len(accounts)):
-        account = accounts[i]
+def _process_account(driver, account, accounts, cutoff=None):
+    """Get entries from a single account and return to the accounts page.
 
+    Entries older than the cutoff date are dropped.
+    """
+    with metrics.stage("scrape account", account=account) as record:
         wait = WebDriverWait(driver, 10)
         account_link = wait.until(
             EC.element_to_be_clickable((By.PARTIAL_LINK_TEXT, account)))
@@ -114,18 +217,89 @@ def _process_accounts(driver, accounts):
         available = format_value(driver.find_element_by_class_name("h2").text)
         sheet.add_bank_balance(available, account, accounts)
 
-        _expand_table(driver)
-
-        # Get table text
-        lines = _get_table_lines(driver)
-        entries = _parse_entries(lines)
+        try:
+            expand_times[account] = _expand_table(driver, cutoff)
+        except TimeoutException:
+            # Don't report the scrape as done with rows missing
+            record["truncated"] = True
+            raise
+        record["expand seconds"] = round(expand_times[account], 4)
+
+        entries = _get_table_entries(driver)
+        if cutoff:
+            entries = [entry for entry in entries if entry["Date"] >= cutoff]
         # Add account field
         for num in range(len(entries)):
             entries[num]["account"] = account
+        record["rows"] = len(entries)
+
+        driver.back()
+
+    return entries
+
+
+def _copy_session(cookies, url, info):
+    """Start another driver which shares the session of a logged in driver."""
+    # Cookies can only be added to the page they are for, which may be on
+    # another host than the login page
+    driver = _get_driver(info, HEADLESS, url=url)
+    try:
+        _add_cookies(driver, cookies)
+        driver.get(url)
+    except Exception:
+        driver.quit()
+        raise
+    return driver
+
+
+def _process_accounts_parallel(driver, accounts, info, cutoff=None):
+    """Get entries from every account with several drivers at once."""
+    workers = min(PARALLEL_ACCOUNTS, len(accounts))
+    cookies = driver.get_cookies()
+    url = driver.current_url
+
+    extra_drivers = []
+    try:
+        # One at a time, so those already started are quit if one fails
+        for _ in range(workers - 1):
+            extra_drivers.append(_copy_session(cookies, url, info))
+
+        # Each account takes whichever driver is free
+        free_drivers = queue.Queue()
+        for free_driver in [driver] + extra_drivers:
+            free_drivers.put(free_driver)
+
+        def _process(account):
+            account_driver = free_drivers.get()
+            try:
+                return _process_account(
+                    account_driver, account, accounts, cutoff)
+            finally:
+                free_drivers.put(account_driver)
+
+        with ThreadPoolExecutor(workers) as executor:
+            account_entries = list(executor.map(_process, accounts))
+    finally:
+        for extra_driver in extra_drivers:
+            extra_driver.quit()
 
+    entries_list = []
+    for entries in account_entries:
         entries_list.extend(entries)
 
-        driver.back()
+    return entries_list
+
+
+def _process_accounts(driver, accounts, info, cutoff=None):
+    """Get entries from every account."""
+    if PARALLEL_ACCOUNTS > 1:
+        return _process_accounts_parallel(driver, accounts, info, cutoff)
+
+    entries_list = []
+
+    for account in accounts:
+        entries_list.extend(
+            _process_account(driver, account, accounts, cutoff))
 
     return entries_list
 
@@ -172,38 +346,127 @@ def _login(driver, info):
     elem.send_keys(Keys.RETURN)
 
 
-def _get_driver(info, headless=True):
-    """Start a headless webdriver."""
+def _get_driver(info, headless=True, profile=False, url=None):
+    """Start a headless webdriver on the url, or the bank's page if not given.
+
+    Only one driver at a time may use the saved profile.
+    """
     options = webdriver.ChromeOptions()
     options.headless = headless
     options.add_argument("log-level=3")
     options.add_argument("--no-sandbox")
+    if profile and PROFILE_DIR:
+        options.add_argument(f"user-data-dir={os.path.abspath(PROFILE_DIR)}")
     options.add_experimental_option("excludeSwitches", ["enable-logging"])
     driver = webdriver.Chrome(options=options)
-    driver.get(info["url"])
+    if isinstance(url, type(None)):
+        url = info["url"]
+    driver.get(url)
     return driver
 
 
+def _add_cookies(driver, cookies):
+    """Add cookies to the page a driver is on, skipping any it rejects."""
+    for cookie in cookies:
+        if "expiry" in cookie:
+            cookie["expiry"] = int(cookie["expiry"])
+        try:
+            driver.add_cookie(cookie)
+        except WebDriverException:
+            # Cookie for another domain
+            continue
+
+
+def _load_cookies(driver, info):
+    """Restore the cookies saved by the last run."""
+    if not os.path.exists(COOKIE_FILE):
+        return
+    try:
+        with open(COOKIE_FILE) as file:
+            cookies = json.load(file)
+    except ValueError:
+        # Cut short by an older version, log in again instead
+        return
+    _add_cookies(driver, cookies)
+    driver.get(info["url"])
+
+
+def _save_cookies(driver):
+    """Save the cookies of the session for the next run."""
+    with atomic_write(COOKIE_FILE) as file:
+        json.dump(driver.get_cookies(), file)
+
+
+def _is_logged_in(driver):
+    """Determine whether the session is still logged in without waiting."""
+    return not driver.find_elements_by_name("username")
+
+
 def _get_bank_info():
     """Load the bank info from the json."""
     with open(BANK_INFO) as file:
         return json.load(file)
 
 
-def get_entries(accounts):
-    """Pull transactions from bank website and handle alerts."""
+def start_session(info=None):
+    """Start a driver which can be reused by calls to get_entries."""
+    if isinstance(info, type(None)):
+        info = _get_bank_info()
+    driver = _get_driver(info, HEADLESS, profile=True)
+    _load_cookies(driver, info)
+    return driver
+
 
-    def _get_entries(accounts, driver, info):
-        """Go through the steps of getting transactions from bank website."""
+def log_in(driver, info=None, reload=False):
+    """Log a driver from start_session in, unless its session is still logged in.
+
+    Lets the browser log in before the accounts to scrape are known. With reload,
+    the bank's page is opened again first, for a driver left on another page.
+    """
+    if isinstance(info, type(None)):
+        info = _get_bank_info()
+    if reload:
+        driver.get(info["url"])
+    if not _is_logged_in(driver):
         _login(driver, info)
         _security_question(driver, info)
-        entries = _process_accounts(driver, accounts)
+
+
+def end_session(driver):
+    """Close a driver started by start_session."""
+    try:
+        driver.close()
+    except WebDriverException:
+        # Window is already gone
+        pass
+    driver.quit()
+
+
+def get_entries(accounts, cutoff=None, driver=None, logged_in=False):
+    """Pull transactions from bank website and handle alerts.
+
+    Only transactions on or after the cutoff date are pulled, if one is given. A
+    driver from start_session is reused and left open, otherwise one is started and
+    closed. If logged_in, the driver was logged in by log_in and is scraped from the
+    page it is on, without loading the bank's page or logging in again.
+    """
+
+    def _get_entries(accounts, driver, info, logged_in=False):
+        """Go through the steps of getting transactions from bank website."""
+        if not logged_in:
+            log_in(driver, info)
+        entries = _process_accounts(driver, accounts, info, cutoff)
+        _save_cookies(driver)
         return entries
 
     info = _get_bank_info()
-    driver = _get_driver(info, HEADLESS)
+    reuse_driver = not isinstance(driver, type(None))
     try:
-        return _get_entries(accounts, driver, info)
+        if not reuse_driver:
+            driver = start_session(info)
+        elif not logged_in:
+            driver.get(info["url"])
+        return _get_entries(accounts, driver, info, logged_in)
     except UnexpectedAlertPresentException:
         # Try one more time if an alert appears.
         # Appears to happen after answering security questions which should
@@ -211,5 +474,5 @@ def get_entries(accounts):
         # necessary once anyway.
         return _get_entries(accounts, driver, info)
     finally:
-        driver.close()
-        driver.quit()
+        if not reuse_driver and not isinstance(driver, type(None)):
+            end_session(driver)
@@ -0,0 +1 @@
+"""Benchmarks for the slow parts of a run. Run from the repository root."""
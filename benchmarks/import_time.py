@@ -0,0 +1,45 @@
+"""Time importing each module of the script in a fresh interpreter.
+
+Run with python -m benchmarks.import_time
+"""
+import subprocess
+import sys
+
+MODULES = ("main", "sheet", "sheets_api", "ledger", "scoring", "bank_website")
+HEAVY_MODULES = ("selenium", "googleapiclient", "oauth2client", "httplib2", "numpy")
+REPEATS = 5
+IMPORT_SCRIPT = """
+import sys
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print(" ".join(name for name in {heavy} if name in sys.modules))
+"""
+
+
+def _time_import(module):
+    """Import a module in a new interpreter, return the seconds and heavy imports."""
+    script = IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+    result = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True
+    )
+    seconds, heavy = result.stdout.split("\n")[:2]
+    return float(seconds), heavy
+
+
+def main():
+    """Print the fastest import time of every module."""
+    for module in MODULES:
+        try:
+            times = [_time_import(module) for _ in range(REPEATS)]
+        except subprocess.CalledProcessError as e:
+            print(f"{module:<15}failed: {e.stderr.strip().splitlines()[-1]}")
+            continue
+        seconds = min(seconds for seconds, _ in times)
+        heavy = times[0][1] or "-"
+        print(f"{module:<15}{seconds * 1000:8.1f} ms  loads: {heavy}")
+
+
+if __name__ == "__main__":
+    main()
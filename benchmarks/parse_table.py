@@ -0,0 +1,82 @@
+"""Compare pulling the transaction table as text and as rows of cells.
+
+Run with python -m benchmarks.parse_table
+"""
+import datetime
+import os
+import random
+import tempfile
+import timeit
+
+import bank_website
+
+NUM_ROWS = 5000
+REPEATS = 5
+FIXTURE_STYLE = """
+tr { display: block; }
+td { display: inline; }
+td:nth-child(3) { display: block; }
+"""
+
+
+def _write_fixture(path, num_rows):
+    """Write a saved transaction table with the given number of rows."""
+    rand = random.Random(0)
+    date = datetime.date.today()
+    rows = []
+    for num in range(num_rows):
+        date -= datetime.timedelta(days=rand.randint(0, 2))
+        status = "Pending transaction" if num < 5 else "Posted transaction"
+        amount = rand.randint(-50000, 50000) / 100
+        balance = rand.randint(0, 500000) / 100
+        cells = (
+            status,
+            date.strftime(bank_website.DATE_FORMAT),
+            f"POS PURCHASE MERCHANT {rand.randint(0, 500)}",
+            f"${amount:,.2f}",
+            f"${balance:,.2f}",
+        )
+        rows.append("<tr>" + "".join(f"<td>{cell}</td>" for cell in cells) + "</tr>")
+
+    with open(path, "w") as fixture:
+        fixture.write(
+            f"<html><head><style>{FIXTURE_STYLE}</style></head><body>"
+            '<table id="table--transactions">'
+            "<thead><tr><th>Date</th></tr><tr><th>Description</th></tr></thead>"
+            f"<tbody>{''.join(rows)}</tbody></table></body></html>"
+        )
+
+
+def main():
+    """Time both ways of pulling the table."""
+    fixture_dir = tempfile.mkdtemp()
+    path = os.path.join(fixture_dir, "transactions.html")
+    _write_fixture(path, NUM_ROWS)
+
+    driver = bank_website._get_driver({"url": "file://" + path})
+    try:
+        text_entries = bank_website._parse_entries(
+            bank_website._get_table_lines(driver))
+        row_entries = bank_website._parse_rows(
+            bank_website._get_table_rows(driver))
+        if text_entries != row_entries:
+            raise Exception("Text and row parsing disagree")
+
+        text_time = timeit.timeit(
+            lambda: bank_website._parse_entries(
+                bank_website._get_table_lines(driver)),
+            number=REPEATS) / REPEATS
+        row_time = timeit.timeit(
+            lambda: bank_website._parse_rows(
+                bank_website._get_table_rows(driver)),
+            number=REPEATS) / REPEATS
+    finally:
+        driver.quit()
+
+    print(f"{NUM_ROWS} rows")
+    print(f"text: {text_time:.3f}s")
+    print(f"rows: {row_time:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
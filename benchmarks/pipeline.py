@@ -0,0 +1,151 @@
+"""Time each stage of reconciling synthetic ledgers of increasing size.
+
+Run with python -m benchmarks.pipeline from the repository root. Use --save to store
+the results as the baseline which later runs are compared against.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+import main
+import sheet
+import sheets_api
+from benchmarks import synthetic
+
+SIZES = (1000, 10000, 100000)
+BASELINE_FILE = "benchmark_baseline.json"
+TOLERANCE = 0.25  # Fraction slower than the baseline which counts as a regression
+MIN_SECONDS = 0.01  # Stages faster than this are too noisy to compare
+
+
+def _measure(function):
+    """Run a function, returning its result, seconds taken and peak memory in bytes.
+
+    Memory is measured on a second run as tracing slows the function down.
+    """
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, seconds, peak
+
+
+def _run_stages(grid, bank_entries):
+    """Run every stage of a reconciliation, yielding its name and measurements."""
+
+    def _get_range(range_name):
+        # Single cells, such as Sheet1!G6
+        match = re.fullmatch(r".*!([A-Z])(\d+)", range_name)
+        if match:
+            column, row = ord(match[1]) - ord("A"), int(match[2])
+            return [grid[row - 1][column:column + 1]]
+        # Ranges of whole rows, such as Sheet1!9:5008
+        match = re.fullmatch(r".*!(\d+):(\d+)", range_name)
+        start_row, end_row = map(int, match.groups())
+        return grid[start_row - 1:end_row]
+
+    sheets_api.get_range = _get_range
+    sheet.INCREMENTAL_READS = False
+
+    accounts = sheet.get_accounts()
+    fields = sheet.get_fields()
+    sheet_entries, *measurements = _measure(lambda: sheet.get_entries(fields, accounts))
+    yield "parse sheet", measurements
+
+    try:
+        import bank_website
+    except ImportError:
+        yield "parse bank", None
+    else:
+        lines = synthetic.to_lines(bank_entries)
+        _, *measurements = _measure(lambda: bank_website._parse_entries(lines))
+        yield "parse bank", measurements
+
+    bank_entries = sorted(bank_entries, key=lambda entry: entry["Date"])
+    all_scores, *measurements = _measure(
+        lambda: main._score_candidates(sheet_entries, bank_entries, accounts))
+    yield "score", measurements
+
+    matches, *measurements = _measure(
+        lambda: main._find_perfect_matches(sheet_entries, all_scores))
+    yield "perfect matches", measurements
+
+    def _find_imperfect_matches():
+        matched_sheet_indices, matched_bank_indices = map(set, matches)
+        with contextlib.redirect_stdout(io.StringIO()):
+            main._find_imperfect_matches(
+                sheet_entries,
+                bank_entries,
+                all_scores,
+                matched_bank_indices,
+                matched_sheet_indices,
+                fields,
+                accounts,
+            )
+        sheets_api.discard()
+
+    _, *measurements = _measure(_find_imperfect_matches)
+    yield "imperfect matches", measurements
+
+
+def _check(name, seconds, baseline):
+    """Determine whether a stage is slower than its baseline beyond the tolerance."""
+    if name not in baseline or max(seconds, baseline[name]) < MIN_SECONDS:
+        return True
+    return seconds <= baseline[name] * (1 + TOLERANCE)
+
+
+def main_benchmark(sizes, save):
+    """Run the benchmark for every size, returning whether nothing regressed."""
+    baseline = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = {}
+    passed = True
+    print(f"{'stage':<30}{'seconds':>10}{'peak MB':>10}{'baseline':>10}")
+    for size in sizes:
+        grid, bank_entries = synthetic.generate(size)
+        for stage, measurements in _run_stages(grid, bank_entries):
+            name = f"{stage} ({size} rows)"
+            if isinstance(measurements, type(None)):
+                print(f"{name:<30}{'skipped':>10}")
+                continue
+            seconds, peak = measurements
+            results[name] = seconds
+
+            ok = _check(name, seconds, baseline)
+            passed = passed and ok
+            base = f"{baseline[name]:.3f}" if name in baseline else "-"
+            flag = "" if ok else "  REGRESSED"
+            print(f"{name:<30}{seconds:>10.3f}{peak / 2 ** 20:>10.1f}{base:>10}{flag}")
+
+    if save:
+        with open(BASELINE_FILE, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=SIZES, help="sheet rows to test"
+    )
+    parser.add_argument(
+        "--save", action="store_true", help="save the results as the baseline"
+    )
+    args = parser.parse_args()
+    sys.exit(0 if main_benchmark(args.sizes, args.save) else 1)
@@ -0,0 +1,152 @@
+"""Generate realistic sheets and bank tables of any size."""
+import datetime
+import random
+import re
+
+import categories
+import sheet
+
+ACCOUNTS = ("Checking", "Savings", "Credit")
+FIELDS = (
+    "Date",
+    "Checking",
+    "Checking Running",
+    "Savings",
+    "Savings Running",
+    "Credit",
+    "Credit Running",
+    "Bank Listed Item",
+    "Method",
+    "PayPal",
+    "In Account",
+    "Pending",
+)
+MERCHANTS = (
+    "POS PURCHASE AMAZON MKTPLACE",
+    "POS PURCHASE KROGER #{}",
+    "DEBIT CARD SHELL OIL {}",
+    "ACH DEPOSIT PAYROLL",
+    "ACH WITHDRAWAL ELECTRIC CO",
+    "CHECK {}",
+    "PAYPAL INST XFER {}",
+    "ACCR EARNING PYMT",
+)
+# Amounts which recur, making near duplicates
+RECURRING_AMOUNTS = (-4.99, -12.5, -45.0, -60.0, -100.0, 1500.0)
+PENDING_FRACTION = 0.02  # Newest sheet rows still pending
+MATCHED_FRACTION = 0.8  # Bank entries which are already in the sheet
+BANK_DATE_FORMAT = "%b %d, %Y"
+
+
+def _get_description(rand):
+    """Make a description as the bank would list it."""
+    return rand.choice(MERCHANTS).format(rand.randint(1000, 9999))
+
+
+def _drift(rand, description):
+    """Change a description slightly, as the bank does between runs."""
+    choice = rand.random()
+    if choice < 0.1:
+        return description[:max(len(description) - rand.randint(1, 8), 3)]
+    elif choice < 0.2:
+        return description + f" {rand.randint(100, 999)}"
+    return description
+
+
+def _get_amount(rand):
+    """Make an amount, often close to one which recurs."""
+    if rand.random() < 0.5:
+        return rand.choice(RECURRING_AMOUNTS) + rand.choice((0, 0, 0.01, -0.3))
+    return round(rand.uniform(-300, 300), 2)
+
+
+def _format_money(amount):
+    """Format an amount as the sheet and bank display it."""
+    sign = "-" if amount < 0 else ""
+    return f"{sign}${abs(amount):,.2f}"
+
+
+def generate(num_rows, num_bank=None, seed=0):
+    """Generate a sheet and a bank table.
+
+    Returns the grid of sheet values as returned by sheets_api.get_range and the bank
+    entries as returned by bank_website.get_entries.
+    """
+    rand = random.Random(seed)
+    if isinstance(num_bank, type(None)):
+        num_bank = max(num_rows // 20, 10)
+
+    header = [["Account", *ACCOUNTS]] + [[] for _ in range(sheet.FIELD_ROW - 2)]
+    # Running balances are summed from the first entry
+    start_column, start_row = re.fullmatch(r"\$(\w)\$(\d+)", sheet.START_CELL).groups()
+    header[int(start_row) - 1] = [""] * (ord(start_column) - ord("A"))
+    header[int(start_row) - 1].append(str(sheet.get_row(0)))
+    header.append([f"{field}*" if "Running" not in field else field
+                   for field in FIELDS])
+    columns = {field: num for num, field in enumerate(FIELDS)}
+
+    date = datetime.datetime(2000, 1, 1)
+    balances = {account: 0 for account in ACCOUNTS}
+    rows = []
+    transactions = []
+    for num in range(num_rows):
+        date += datetime.timedelta(days=rand.choice((0, 0, 0, 1)))
+        account = rand.choice(ACCOUNTS)
+        amount = _get_amount(rand)
+        balances[account] = round(balances[account] + amount, 2)
+        description = _get_description(rand)
+        pending = num >= num_rows * (1 - PENDING_FRACTION)
+
+        row = [""] * len(FIELDS)
+        row[columns["Date"]] = date.strftime(sheet.DATE_FORMAT)
+        row[columns[account]] = _format_money(amount)
+        row[columns[account + " Running"]] = _format_money(balances[account])
+        row[columns["Bank Listed Item"]] = description
+        row[columns["Method"]] = categories.classify(description)["Method"]
+        row[columns["PayPal"]] = categories.classify(description)["PayPal"]
+        row[columns["In Account"]] = "Yes"
+        row[columns["Pending"]] = "Yes" if pending else "No"
+        rows.append(row)
+        transactions.append((date, account, amount, balances[account], description))
+
+    bank_entries = []
+    latest = date
+    tail = transactions[-num_bank:]
+    for num in range(num_bank):
+        if rand.random() < MATCHED_FRACTION and tail:
+            date, account, amount, balance, description = tail[num % len(tail)]
+            date += datetime.timedelta(days=rand.choice((0, 0, 1, 2)))
+            description = _drift(rand, description)
+        else:
+            latest += datetime.timedelta(days=rand.choice((0, 1)))
+            date = latest
+            account = rand.choice(ACCOUNTS)
+            amount = _get_amount(rand)
+            balance = ""
+            description = _get_description(rand)
+        pending = rand.random() < 0.05
+        status = ("Posted transaction", "Pending transaction")[pending]
+        bank_entries.append({
+            "Transaction Status": status,
+            "Date": date,
+            "Description": description,
+            "Amount": float(amount),
+            "Balance": "" if pending else balance,
+            "account": account,
+        })
+
+    return header + rows, bank_entries
+
+
+def to_lines(bank_entries):
+    """Convert bank entries to the lines of text the bank table displays."""
+    lines = []
+    for entry in bank_entries:
+        lines.append(
+            f"{entry['Transaction Status']} {entry['Date'].strftime(BANK_DATE_FORMAT)}")
+        lines.append(entry["Description"])
+        amounts = _format_money(entry["Amount"])
+        if entry["Balance"] != "":
+            amounts += " " + _format_money(entry["Balance"])
+        lines.append(amounts)
+    return lines
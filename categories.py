@@ -0,0 +1,114 @@
+"""Handle filling fields of new sheet entries from the words in their descriptions."""
+import functools
+import json
+import os
+
+RULES_FILE = "categories.json"  # Rules replacing or adding to RULES, if it exists
+CACHE_SIZE = 2 ** 16  # Distinct descriptions remembered
+# Value of each field by the words a description may contain, checked in order
+RULES = {
+    "Method": {
+        "default": "Card",
+        "values": {
+            "Direct": ["deposit", "ach", "accr earning pymt"],
+            "Check": ["check"],
+            "Card": ["pos", "debit", "card"],
+        },
+    },
+    "PayPal": {"default": "No", "values": {"Yes": ["paypal"]}},
+}
+
+_rules = None  # Rules of each field in use, loaded when first needed
+_transitions = None  # Next state of the automaton by state and letter
+_outputs = None  # Field and rank of the value of each word ending at each state
+_values = None  # Values in order and default of each field
+
+
+def _compile(rules):
+    """Compile the words of every field into a single automaton (Aho-Corasick).
+
+    Reading a description one letter at a time, each state is the longest end of
+    the text read so far which starts some word, so all words are found in one pass
+    however many rules there are.
+    """
+    transitions = [{}]
+    outputs = [[]]
+    for field, rule in rules.items():
+        for rank, value in enumerate(rule["values"]):
+            for word in rule["values"][value]:
+                state = 0
+                for letter in word.lower():
+                    if letter not in transitions[state]:
+                        transitions[state][letter] = len(transitions)
+                        transitions.append({})
+                        outputs.append([])
+                    state = transitions[state][letter]
+                # An empty word would match every description
+                if state:
+                    outputs[state].append((field, rank))
+
+    # Each state falls back to the state of the longest proper end of its text.
+    # Shorter texts come first, so a state's fallback is complete when reached.
+    fallbacks = [0] * len(transitions)
+    queue = list(transitions[0].values())
+    for state in queue:
+        fallback = fallbacks[state]
+        for letter, next_state in transitions[state].items():
+            fallbacks[next_state] = transitions[fallback].get(letter, 0)
+            queue.append(next_state)
+        outputs[state].extend(outputs[fallback])
+        # Take the fallback's transitions now rather than on every letter read
+        transitions[state] = {**transitions[fallback], **transitions[state]}
+
+    return transitions, [tuple(output) for output in outputs]
+
+
+def load(path=None):
+    """Load the rules, with those in the rules file replacing the same fields."""
+    global _rules, _transitions, _outputs, _values
+
+    if isinstance(path, type(None)):
+        path = RULES_FILE
+
+    rules = dict(RULES)
+    if os.path.exists(path):
+        with open(path) as rules_file:
+            rules.update(json.load(rules_file))
+    _transitions, _outputs = _compile(rules)
+    _values = {
+        field: (list(rule["values"]), rule.get("default", ""))
+        for field, rule in rules.items()
+    }
+    _rules = rules
+    classify.cache_clear()
+
+
+def get_fields():
+    """Get the fields filled from descriptions."""
+    if isinstance(_rules, type(None)):
+        load()
+    return tuple(_rules)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def classify(description):
+    """Get the value of every field filled from a description.
+
+    A field's value is the first in its rules with a word in the description, else
+    its default. Case is ignored.
+    """
+    if isinstance(_rules, type(None)):
+        load()
+
+    ranks = {}
+    state = 0
+    for letter in description.lower():
+        state = _transitions[state].get(letter, 0)
+        for field, rank in _outputs[state]:
+            if rank < ranks.get(field, rank + 1):
+                ranks[field] = rank
+
+    values = {}
+    for field, (field_values, default) in _values.items():
+        values[field] = field_values[ranks[field]] if field in ranks else default
+    return values
@@ -0,0 +1,267 @@
+"""Handle fuzzy comparison of the descriptions of sheet and bank entries."""
+import array
+import functools
+import os
+import re
+import zipfile
+
+from files import atomic_write
+
+CACHE_SIZE = 2 ** 16  # Distinct descriptions and pairs remembered between runs
+MIN_SIMILARITY = 0.5  # Descriptions less similar than this are entirely different
+SEPARATORS = re.compile(r"[^a-z0-9]+")
+BINS = 64  # Groups of trigram ids, one per bit of an integer, to rule out pairs
+INDEX_FILE = "descriptions.npz"  # Index of descriptions kept between runs
+
+_descriptions = []  # Indexed descriptions by id
+_ids = {}  # Id of each indexed description
+_trigram_ids = {}  # Id of each trigram of an indexed description
+_sizes = array.array("i")  # Number of trigrams of each description
+_trigrams = array.array("i")  # Ids of the trigrams of each description in order
+_table = None  # Arrays of the trigrams, rebuilt after indexing
+
+
+def _pad(description):
+    """Normalize a description to its words and numbers, padded by spaces.
+
+    Case and punctuation are ignored, so only letters, digits and spaces are left.
+    """
+    words = SEPARATORS.sub(" ", description.lower()).strip()
+    return f"  {words} "
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def get_trigrams(description):
+    """Get the set of three letter sequences in a normalized description."""
+    padded = _pad(description)
+    return frozenset(padded[ind:ind + 3] for ind in range(len(padded) - 2))
+
+
+def _get_diff(similarity):
+    """Get how different two descriptions are from how similar they are."""
+    if similarity < MIN_SIMILARITY:
+        return 1
+    return 1 - similarity
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def get_diff(sheet_desc, bank_desc):
+    """Get how different two descriptions are, from 0 if equal to 1.
+
+    Based on the trigrams they share, so truncated or reworded descriptions are
+    still close.
+    """
+    if sheet_desc.strip() == bank_desc.strip():
+        return 0
+    sheet_trigrams = get_trigrams(sheet_desc)
+    bank_trigrams = get_trigrams(bank_desc)
+    shared = len(sheet_trigrams & bank_trigrams)
+    return _get_diff(2 * shared / (len(sheet_trigrams) + len(bank_trigrams)))
+
+
+def get_id(description):
+    """Get the id of a description in the index, adding it if new.
+
+    Equal descriptions share an id. The trigrams of new descriptions are indexed
+    together when next needed.
+    """
+    description = description.strip()
+    desc_id = _ids.get(description)
+    if isinstance(desc_id, type(None)):
+        desc_id = _ids[description] = len(_descriptions)
+        _descriptions.append(description)
+    return desc_id
+
+
+def _index_new():
+    """Add the trigrams of the descriptions added since the last time to the index.
+
+    Normalized descriptions are plain ascii, so the trigrams of all of them are read
+    at once from their bytes, as the three bytes of an integer.
+    """
+    global _table
+
+    import numpy as np
+
+    padded = [_pad(description) for description in _descriptions[len(_sizes):]]
+    if not padded:
+        return
+
+    lengths = np.array([len(text) for text in padded])
+    letters = np.frombuffer("".join(padded).encode("ascii"), dtype=np.uint8)
+    letters = letters.astype(np.int64)
+    codes = letters[:-2] << 16 | letters[1:-1] << 8 | letters[2:]
+
+    # Trigrams running from one description into the next are left out
+    counts = lengths - 2
+    offsets = np.cumsum(counts) - counts
+    positions = np.arange(counts.sum()) + np.repeat(
+        np.cumsum(lengths) - lengths - offsets, counts
+    )
+    rows = np.repeat(np.arange(len(padded)), counts)
+    keys = np.sort(rows << 24 | codes[positions])
+    # Only the first of each repeated trigram of a description
+    keys = keys[np.append(True, keys[1:] != keys[:-1])]
+    rows, codes = keys >> 24, keys & 0xFFFFFF
+
+    distinct_codes, inverse = np.unique(codes, return_inverse=True)
+    trigram_ids = [
+        _trigram_ids.setdefault(code.to_bytes(3, "big").decode(), len(_trigram_ids))
+        for code in distinct_codes.tolist()
+    ]
+    _sizes.extend(np.bincount(rows, minlength=len(padded)).tolist())
+    _trigrams.extend(np.array(trigram_ids)[inverse].tolist())
+    _table = None
+
+
+def _get_table():
+    """Get the trigram ids of every description, where each starts and how many.
+
+    Also gets the bins of trigram ids each description has (as bits) and how many
+    of its trigrams share a bin with another of them.
+    """
+    global _table
+
+    import numpy as np
+
+    _index_new()
+    if isinstance(_table, type(None)):
+        sizes = np.array(_sizes, dtype=np.int32)
+        starts = np.cumsum(sizes) - sizes
+        trigrams = np.array(_trigrams, dtype=np.int32)
+        rows = np.repeat(np.arange(len(sizes)), sizes)
+        counts = np.bincount(
+            rows * BINS + trigrams % BINS, minlength=len(sizes) * BINS
+        ).reshape(-1, BINS)
+        bits = np.packbits(counts > 0, axis=1, bitorder="little").view(np.uint64)
+        extras = (sizes - np.count_nonzero(counts, axis=1)).astype(np.int32)
+        _table = (trigrams, starts, sizes, bits.ravel(), extras)
+    return _table
+
+
+def _count_bits(values):
+    """Count the bits set in each of an array of 64 bit integers."""
+    import numpy as np
+
+    if hasattr(np, "bitwise_count"):
+        # Added in numpy 2.0
+        return np.bitwise_count(values)
+    values = values - ((values >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    values = (values & np.uint64(0x3333333333333333)) + (
+        (values >> np.uint64(2)) & np.uint64(0x3333333333333333)
+    )
+    values = (values + (values >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return ((values * np.uint64(0x0101010101010101)) >> np.uint64(56)).astype(int)
+
+
+def _count_shared(desc_ids, other_ids):
+    """Count the trigrams shared by each pair of indexed descriptions.
+
+    Pairs must be sorted by their first description.
+    """
+    import numpy as np
+
+    trigrams, starts, sizes, _, _ = _get_table()
+
+    def _get_positions(ids):
+        # Positions in the table of the trigrams of each description in turn
+        ids_sizes = sizes[ids]
+        offsets = np.cumsum(ids_sizes) - ids_sizes
+        positions = np.arange(ids_sizes.sum()) + np.repeat(
+            starts[ids] - offsets, ids_sizes
+        )
+        return positions, offsets
+
+    # Mark the trigrams of each first description in a row of its own
+    is_first = np.ones(len(desc_ids), dtype=bool)
+    is_first[1:] = desc_ids[1:] != desc_ids[:-1]
+    first_ids = desc_ids[is_first]
+    rows = (np.cumsum(is_first) - 1) * len(_trigram_ids)
+    positions, _ = _get_positions(first_ids)
+    is_shared = np.zeros(len(first_ids) * len(_trigram_ids), dtype=bool)
+    is_shared[
+        np.repeat(np.arange(len(first_ids)) * len(_trigram_ids), sizes[first_ids])
+        + trigrams[positions]
+    ] = True
+
+    positions, offsets = _get_positions(other_ids)
+    return np.add.reduceat(
+        is_shared[np.repeat(rows, sizes[other_ids]) + trigrams[positions]],
+        offsets,
+        dtype=np.int64,
+    )
+
+
+def get_diffs(desc_ids, other_ids):
+    """Get how different each pair of indexed descriptions is, as get_diff does.
+
+    Pairs whose trigrams fall in too few of the same bins can't be similar, which
+    rules out most of them without comparing trigrams. Each remaining distinct pair
+    is compared once.
+    """
+    import numpy as np
+
+    _, _, sizes, bits, extras = _get_table()
+    most_shared = _count_bits(bits[desc_ids] & bits[other_ids]) + np.minimum(
+        extras[desc_ids], extras[other_ids]
+    )
+    total = sizes[desc_ids] + sizes[other_ids]
+    similar = np.flatnonzero(2 * most_shared >= MIN_SIMILARITY * total)
+
+    pairs, inverse = np.unique(
+        desc_ids[similar] * len(sizes) + other_ids[similar], return_inverse=True
+    )
+    diffs = np.ones(len(desc_ids))
+    if len(pairs):
+        shared = _count_shared(pairs // len(sizes), pairs % len(sizes))
+        similarity = 2 * shared[inverse] / total[similar]
+        close = similarity >= MIN_SIMILARITY
+        diffs[similar[close]] = 1 - similarity[close]
+    return diffs
+
+
+def load():
+    """Load the index saved by the last run, if the index is still empty."""
+    global _table
+
+    try:
+        import numpy as np
+    except ImportError:
+        # Only scoring with numpy uses the index
+        return
+
+    if _descriptions or not os.path.exists(INDEX_FILE):
+        return
+    try:
+        with np.load(INDEX_FILE) as index:
+            saved_descriptions = index["descriptions"].tolist()
+            trigram_names = index["trigram_names"].tolist()
+            sizes = index["sizes"].tolist()
+            trigrams = index["trigrams"].tolist()
+    except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+        # Unreadable, such as cut short by an older version, so index from scratch
+        return
+    _descriptions.extend(saved_descriptions)
+    _sizes.extend(sizes)
+    _trigrams.extend(trigrams)
+    _ids.update((description, num) for num, description in enumerate(_descriptions))
+    _trigram_ids.update((trigram, num) for num, trigram in enumerate(trigram_names))
+    _table = None
+
+
+def save():
+    """Save the index so the next run only indexes new descriptions."""
+    try:
+        import numpy as np
+    except ImportError:
+        return
+
+    _index_new()
+    with atomic_write(INDEX_FILE, "wb") as index_file:
+        np.savez(
+            index_file,
+            descriptions=np.array(_descriptions, dtype=str),
+            trigram_names=np.array(list(_trigram_ids), dtype=str),
+            sizes=np.array(_sizes, dtype=np.int32),
+            trigrams=np.array(_trigrams, dtype=np.int32),
+        )
@@ -0,0 +1,108 @@
+"""Handle compact storage of sheet and bank entries."""
+from collections.abc import MutableMapping
+
+MISSING = object()  # Value of a field an entry doesn't have
+
+
+def get_columns(names):
+    """Get the positions of named fields, to be shared by entries of one table."""
+    return {name: position for position, name in enumerate(names)}
+
+
+def _has_amount(entry, account):
+    """Determine whether the amount of an account isn't blank in a sheet entry."""
+    # Indexed rather than through get, as this is called per entry when scoring
+    try:
+        return entry[account] != ""
+    except KeyError:
+        return False
+
+
+def get_amount_accounts(entry, accounts):
+    """Get the accounts whose amounts aren't blank in a sheet entry.
+
+    Usually one, but a transfer between accounts can have an amount in each.
+    """
+    return tuple(account for account in accounts if _has_amount(entry, account))
+
+
+def get_amount_account(entry, accounts):
+    """Get the first account whose amount isn't blank in a sheet entry, or None.
+
+    This is the account the entry is matched against bank entries by.
+    """
+    for account in accounts:
+        if _has_amount(entry, account):
+            return account
+    return None
+
+
+class Entry(MutableMapping):
+    """A sheet or bank entry which is accessed like a dict.
+
+    Entries of the same table share one dict of column positions and only store a
+    list of values, so a ledger doesn't hold a dict per row.
+    """
+
+    __slots__ = ("_columns", "_values")
+
+    def __init__(self, columns, values=None):
+        self._columns = columns
+        if isinstance(values, type(None)):
+            values = [MISSING] * len(columns)
+        self._values = values
+
+    @classmethod
+    def from_dict(cls, columns, values):
+        """Create an entry from a dict of values."""
+        entry = cls(columns)
+        for name in values:
+            entry[name] = values[name]
+        return entry
+
+    def _get(self, name):
+        """Get the value of a field, or MISSING."""
+        position = self._columns.get(name)
+        if isinstance(position, type(None)) or position >= len(self._values):
+            return MISSING
+        return self._values[position]
+
+    def __getitem__(self, name):
+        # Read directly rather than through _get, as this is called per field
+        position = self._columns[name]
+        value = self._values[position] if position < len(self._values) else MISSING
+        if value is MISSING:
+            raise KeyError(name)
+        return value
+
+    def get(self, name, default=None):
+        value = self._get(name)
+        return default if value is MISSING else value
+
+    def __contains__(self, name):
+        return self._get(name) is not MISSING
+
+    def __setitem__(self, name, value):
+        if name not in self._columns:
+            # New column for every entry of the table
+            self._columns[name] = len(self._columns)
+        position = self._columns[name]
+        if position >= len(self._values):
+            self._values.extend([MISSING] * (position + 1 - len(self._values)))
+        self._values[position] = value
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self._values[self._columns[name]] = MISSING
+
+    def __iter__(self):
+        for name, position in self._columns.items():
+            if position < len(self._values) and self._values[position] is not MISSING:
+                yield name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"Entry({dict(self)})"
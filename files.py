@@ -0,0 +1,16 @@
+"""Handle writing the files kept between runs."""
+import contextlib
+import os
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode="w"):
+    """Open a file which replaces the one at path once written.
+
+    It is replaced in one step, so an interrupted write can't leave it truncated.
+    Nothing is replaced if writing fails.
+    """
+    temp_path = path + ".tmp"
+    with open(temp_path, mode) as file:
+        yield file
+    os.replace(temp_path, path)
@@ -1,8 +1,13 @@
 """Handle formatting of entries."""
 from datetime import datetime
+import functools
 import re
 
 PENDING_TAG = "Memo Post"
+CACHE_SIZE = 4096  # Distinct values remembered by each converter
+MONEY_CHARACTERS = re.compile("[,$]")
+# Date formats made only of these are parsed without strptime
+FAST_DIRECTIVES = {"%m": r"(\d{1,2})", "%d": r"(\d{1,2})", "%Y": r"(\d{4})"}
 
 
 def is_num(value):
@@ -14,13 +19,55 @@ def is_num(value):
         return False
 
 
-def format_value(value, field="", date_format=""):
-    """Format as date, number, or original."""
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _to_number(value):
+    """Format as number, or original if not a number."""
+    num_val = MONEY_CHARACTERS.sub("", value)
+    if is_num(num_val):
+        return float(num_val)
+    return value
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _strptime(value, date_format):
+    """Parse a date with strptime, remembering the result."""
+    return datetime.strptime(value, date_format)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_date_parser(date_format):
+    """Get a function which parses dates in the given format."""
+    parts = re.split("(%.)", date_format)
+    directives = parts[1::2]
+    if sorted(directives) != sorted(FAST_DIRECTIVES):
+        return functools.partial(_strptime, date_format=date_format)
+
+    pattern = re.compile(
+        "".join(FAST_DIRECTIVES.get(part, re.escape(part)) for part in parts)
+    )
+
+    @functools.lru_cache(maxsize=CACHE_SIZE)
+    def _parse_date(value):
+        match = pattern.fullmatch(value)
+        if not match:
+            # Let strptime handle anything unusual
+            return _strptime(value, date_format)
+        values = dict(zip(directives, map(int, match.groups())))
+        return datetime(values["%Y"], values["%m"], values["%d"])
+
+    return _parse_date
+
+
+def get_converter(field="", date_format=""):
+    """Get the function which formats values of a field.
+
+    Pick it once per column rather than calling format_value for every value.
+    """
     if field == "Date":
-        return datetime.strptime(value, date_format)
-    else:
-        num_val = re.sub("[,$]", "", value)
-        if is_num(num_val):
-            return float(num_val)
+        return _get_date_parser(date_format)
+    return _to_number
 
-    return value
+
+def format_value(value, field="", date_format=""):
+    """Format as date, number, or original."""
+    return get_converter(field, date_format)(value)
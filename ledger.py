@@ -0,0 +1,146 @@
+"""Handle the local SQLite mirror of the sheet."""
+import datetime
+import hashlib
+import json
+import sqlite3
+
+from entries import get_amount_account
+
+LEDGER_FILE = "ledger.sqlite3"
+
+_connection = None
+
+
+def _execute(query, parameters=()):
+    """Run a query on the ledger."""
+    return _connection.execute(query, parameters)
+
+
+def connect(fields, accounts):
+    """Open the ledger, clearing it if the layout of the sheet has changed."""
+    global _connection
+    _connection = sqlite3.connect(LEDGER_FILE)
+    with _connection:
+        _execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "row INTEGER PRIMARY KEY, date INTEGER, account TEXT, amount REAL, "
+            "balance REAL, description TEXT, entry TEXT, checksum TEXT)"
+        )
+        # Made by older versions, but never queried so only slowed down writes
+        _execute("DROP INDEX IF EXISTS entries_amount")
+        _execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+        layout = json.dumps([fields, accounts])
+        if get_meta("layout") != layout:
+            _execute("DELETE FROM entries")
+            _execute("DELETE FROM meta")
+            set_meta("layout", layout)
+
+
+def get_meta(key, default=None):
+    """Get a value stored alongside the entries."""
+    result = _execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    if isinstance(result, type(None)):
+        return default
+    return json.loads(result[0])
+
+
+def set_meta(key, value):
+    """Store a value alongside the entries."""
+    with _connection:
+        _execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            (key, json.dumps(value)),
+        )
+
+
+def get_checksum(row):
+    """Get the checksum of the raw values of a sheet row."""
+    return hashlib.sha1(json.dumps(row).encode()).hexdigest()
+
+
+def get_block_checksum(checksums):
+    """Combine the checksums of consecutive rows."""
+    return hashlib.sha1("".join(checksums).encode()).hexdigest()
+
+
+def get_stored_checksums(start_row, end_row):
+    """Get the checksums of the stored rows in a range, excluding the end."""
+    result = _execute(
+        "SELECT checksum FROM entries WHERE row >= ? AND row < ? ORDER BY row",
+        (start_row, end_row),
+    )
+    return [checksum for checksum, in result]
+
+
+def get_count():
+    """Get the number of stored rows."""
+    return _execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+
+def _encode(entry):
+    """Convert an entry to text."""
+    values = dict(entry)
+    if isinstance(values.get("Date"), datetime.datetime):
+        values["Date"] = values["Date"].isoformat()
+    return json.dumps(values)
+
+
+def _decode(text):
+    """Convert text back to an entry."""
+    entry = json.loads(text)
+    if "Date" in entry:
+        entry["Date"] = datetime.datetime.fromisoformat(entry["Date"])
+    return entry
+
+
+def _get_columns(entry, accounts):
+    """Get the values stored in their own columns to be queried."""
+    date = entry.get("Date")
+    if isinstance(date, datetime.datetime):
+        date = date.toordinal()
+
+    account = get_amount_account(entry, accounts)
+    amount = balance = None
+    if not isinstance(account, type(None)):
+        amount = entry[account]
+        balance = entry.get(account + " Running")
+
+    return date, account, amount, balance, entry.get("Bank_Listed_Item")
+
+
+def get_entries(end_row):
+    """Get the stored entries before a row."""
+    result = _execute(
+        "SELECT entry FROM entries WHERE row < ? ORDER BY row", (end_row,)
+    )
+    return [_decode(text) for text, in result]
+
+
+def replace_entries(start_row, entries, rows, accounts):
+    """Replace all stored entries from a row onwards.
+
+    Parameters
+    ----------
+    start_row
+        Row in the sheet of the first entry.
+    entries
+        Entries parsed from the rows.
+    rows
+        Raw values of the rows, used for checksums.
+
+    """
+    with _connection:
+        _execute("DELETE FROM entries WHERE row >= ?", (start_row,))
+        _connection.executemany(
+            "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    start_row + num,
+                    *_get_columns(entry, accounts),
+                    _encode(entry),
+                    get_checksum(row),
+                )
+                for num, (entry, row) in enumerate(zip(entries, rows))
+            ),
+        )
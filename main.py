@@ -1,10 +1,22 @@
 #!/usr/bin/env python3.7
 """A rewrite of the banking script."""
+import assignment
+import bank_files
+import descriptions
+from entries import get_amount_account
 import sheets_api
 import sheet
-import bank_website
+import scoring
+import recording
+import metrics
 
+import argparse
+from concurrent.futures import Future, ThreadPoolExecutor
+import cProfile
 import datetime
+import itertools
+import math
+import time
 import traceback
 
 
@@ -23,7 +35,14 @@ MATCH_RANGES = {
     "account diff": 1,
 }
 THRESHOLD = 0.5
+BATCH_SCORING = True  # Score with numpy when it is installed
+BATCH_PAIRS = 2 ** 18  # Max pairs scored with numpy at once, bounding memory
 PROMPT_NEAR_MATCHES = False
+BOUND_SCRAPE_DATES = True  # Only scrape bank entries which may be new to the sheet
+IMPORT_DIR = None  # Read bank entries from files exported to here instead of scraping
+CONCURRENT_SCRAPE = True  # Start the browser and log in while the sheet is read
+DAEMON_INTERVAL = 60 * 60  # Seconds between runs with --daemon
+PROFILE_FILE = None  # Where to dump a cProfile of matching, if anywhere
 LOG_FILE = "log.txt"
 LOG_TIMESTAMP = "%b %d, %Y %I:%M:%S %p"
 
@@ -35,13 +54,11 @@ def _get_match_factors(sheet_entry, bank_entry, accounts):
 
     factors["date diff"] = (bank_entry["Date"] - sheet_entry["Date"]).days
 
-    # Find amount which isn't blank for this entry
-    for account in accounts:
-        sheet_amount = sheet_entry[account]
-        sheet_balance = sheet_entry[account + " Running"]
-        if sheet_amount != "":
-            sheet_account = account
-            break
+    sheet_account = get_amount_account(sheet_entry, accounts)
+    if isinstance(sheet_account, type(None)):
+        raise ValueError("Sheet entry has no amount")
+    sheet_amount = sheet_entry[sheet_account]
+    sheet_balance = sheet_entry[sheet_account + " Running"]
 
     factors["account diff"] = sheet_account != bank_entry["account"]
     factors["amount diff"] = bank_entry["Amount"] - sheet_amount
@@ -57,7 +74,7 @@ def _get_match_factors(sheet_entry, bank_entry, accounts):
     sheet_desc = sheet_entry["Bank_Listed_Item"]
     bank_desc = bank_entry["Description"]
 
-    factors["desc diff"] = sheet_desc.strip() != bank_desc.strip()
+    factors["desc diff"] = descriptions.get_diff(sheet_desc, bank_desc)
 
     return factors
 
@@ -75,55 +92,162 @@ def score_match(sheet_entry, bank_entry, accounts):
     return score
 
 
-def _get_closest_score(scores, matched_indexes):
-    """Find the closest score which is not already accounted for."""
-    closest_score = None
-    closest_ind = None
-    for score_ind, score in enumerate(scores):
-        if score_ind in matched_indexes:
+def _can_prune(factor):
+    """Determine whether falling outside a factor's range alone fails the threshold."""
+    return MATCH_WEIGHTS[factor] / 100 >= THRESHOLD
+
+
+def _get_bucket(value, factor):
+    """Get the bucket of a value such that values in range are in adjacent buckets."""
+    if not _can_prune(factor):
+        return None
+    return math.floor(value / MATCH_RANGES[factor])
+
+
+def _get_index_key(account, amount, date):
+    """Get the key of a sheet or bank entry in the candidate index."""
+    if not _can_prune("account diff"):
+        account = None
+    return (
+        account,
+        _get_bucket(amount, "amount diff"),
+        _get_bucket(date.toordinal(), "date diff"),
+    )
+
+
+def _index_sheet_entries(sheet_entries, accounts):
+    """Index sheet entries by account, amount bucket and date bucket.
+
+    Entries which cannot be indexed are returned separately and are scored against
+    every bank entry.
+    """
+    index = {}
+    unindexed = []
+    for ind, sheet_entry in enumerate(sheet_entries):
+        account = get_amount_account(sheet_entry, accounts)
+        if isinstance(account, type(None)):
+            unindexed.append(ind)
+            continue
+        try:
+            key = _get_index_key(account, sheet_entry[account], sheet_entry["Date"])
+        except (KeyError, TypeError, AttributeError):
+            unindexed.append(ind)
             continue
-        elif isinstance(closest_score, type(None)) or score < closest_score:
-            closest_score = score
-            closest_ind = score_ind
-            if closest_score == 0:
-                break
-
-    return closest_ind
-
-
-def _find_perfect_matches(sheet_entries, bank_entries, fields, accounts):
-    """Find indices of perfect matches and all scores."""
-    all_scores = []
-    matched_sheet_indices = []
-    matched_bank_indices = []
-    # Find all perfect matches
-    for bank_ind, bank_entry in enumerate(bank_entries):
-        scores = []
-        # Start matching
-        for ind, sheet_entry in enumerate(sheet_entries):
-            if ind in matched_sheet_indices:
-                # Already been matched to a bank entry
-                scores.append(-1)
+        index.setdefault(key, []).append(ind)
+
+    return index, unindexed
+
+
+def _get_candidate_keys(bank_entry):
+    """Get the keys of the index buckets holding sheet entries a bank entry may match.
+
+    Returns None if the bank entry cannot be indexed.
+    """
+    try:
+        account, amount_bucket, date_bucket = _get_index_key(
+            bank_entry["account"], bank_entry["Amount"], bank_entry["Date"]
+        )
+    except (TypeError, AttributeError):
+        return None
+
+    def _neighbors(bucket):
+        if isinstance(bucket, type(None)):
+            return (None,)
+        return (bucket - 1, bucket, bucket + 1)
+
+    return list(
+        itertools.product(
+            (account,), _neighbors(amount_bucket), _neighbors(date_bucket)
+        )
+    )
+
+
+def _get_candidates(index, unindexed, keys, num_sheet_entries):
+    """Get indices of sheet entries which may score below the threshold.
+
+    They aren't sorted, as assignment.assign matches the same whatever order each
+    bank entry's pairs are in.
+    """
+    if isinstance(keys, type(None)):
+        # Cannot be indexed, score against everything
+        return range(num_sheet_entries)
+
+    candidates = list(unindexed)
+    for key in keys:
+        candidates.extend(index.get(key, ()))
+
+    return candidates
+
+
+def _score_candidates(sheet_entries, bank_entries, accounts):
+    """Score every bank entry against the sheet entries it may match.
+
+    Returns a dict from sheet index to score for every bank entry, keeping only
+    scores below the threshold.
+    """
+    index, unindexed = _index_sheet_entries(sheet_entries, accounts)
+    all_keys = [_get_candidate_keys(bank_entry) for bank_entry in bank_entries]
+
+    if BATCH_SCORING and scoring.available():
+        # Score all candidates at once
+        all_candidates = scoring.get_candidates(
+            index, unindexed, all_keys, len(sheet_entries)
+        )
+        sheet_columns = scoring.get_sheet_columns(sheet_entries, accounts)
+        bank_columns = scoring.get_bank_columns(bank_entries, accounts)
+        all_scores = scoring.score_candidates(
+            sheet_columns,
+            bank_columns,
+            all_candidates,
+            MATCH_WEIGHTS,
+            MATCH_RANGES,
+            THRESHOLD,
+            BATCH_PAIRS,
+        )
+    else:
+        all_scores = [
+            dict.fromkeys(
+                _get_candidates(index, unindexed, keys, len(sheet_entries)), math.nan
+            )
+            for keys in all_keys
+        ]
+
+    for bank_entry, scores in zip(bank_entries, all_scores):
+        # Scored pairs are already below the threshold
+        if not any(map(math.isnan, scores.values())):
+            continue
+        for ind, score in list(scores.items()):
+            if not math.isnan(score):
                 continue
-            score = score_match(sheet_entry, bank_entry, accounts)
-            scores.append(score)
-            if score == 0:
-                # Found perfect match, stop searching
-                break
+            # Couldn't be scored in a batch
+            score = score_match(sheet_entries[ind], bank_entry, accounts)
+            if score < THRESHOLD:
+                scores[ind] = score
+            else:
+                del scores[ind]
 
-        all_scores.append(scores)
+    return all_scores
 
-        # Determine best score
-        closest_match_ind = _get_closest_score(scores, matched_sheet_indices)
-        closest_score = scores[closest_match_ind]
-        closest_match = sheet_entries[closest_match_ind]
 
-        if closest_score == 0 and not closest_match["Pending"] == "Yes":
-            # Perfect match
-            matched_sheet_indices.append(closest_match_ind)
-            matched_bank_indices.append(bank_ind)
+def _find_perfect_matches(sheet_entries, all_scores):
+    """Find indices of perfect matches.
+
+    Pairs are chosen to match as many entries as possible rather than in bank order.
+    """
+    edges = {}
+    for bank_ind, scores in enumerate(all_scores):
+        if 0 not in scores.values():
+            # Checked as a whole first, as most bank entries have no perfect match
+            continue
+        for ind, score in scores.items():
+            if score == 0 and not sheet_entries[ind]["Pending"] == "Yes":
+                edges[bank_ind, ind] = score
+
+    matches = assignment.assign(edges, 1)
+    matched_sheet_indices = {ind for _, ind in matches}
+    matched_bank_indices = {bank_ind for bank_ind, _ in matches}
 
-    return matched_sheet_indices, matched_bank_indices, all_scores
+    return matched_sheet_indices, matched_bank_indices
 
 
 def print_match(sheet_entry, bank_entry, score, closest_match_ind, accounts):
@@ -160,31 +284,37 @@ def _find_imperfect_matches(
     fields,
     accounts,
 ):
-    """Update matched indices to include imperfect matches."""
-    for ind, bank_entry in enumerate(bank_entries):
+    """Update matched indices to include imperfect matches.
+
+    Near matches are paired to minimize the total score over all entries.
+    """
+    edges = {}
+    for ind, scores in enumerate(all_scores):
         if ind in matched_bank_indices:
             # Already has perfect match
             continue
+        for sheet_ind, score in scores.items():
+            if sheet_ind not in matched_sheet_indices and score < THRESHOLD:
+                edges[ind, sheet_ind] = score
 
-        scores = all_scores[ind]
-        closest_match_ind = _get_closest_score(scores, matched_sheet_indices)
-        closest_score = scores[closest_match_ind]
+    for ind, closest_match_ind in assignment.assign(edges, THRESHOLD):
+        bank_entry = bank_entries[ind]
+        closest_score = edges[ind, closest_match_ind]
         closest_match = sheet_entries[closest_match_ind]
 
-        if closest_score < THRESHOLD:
-            print_match(
-                closest_match, bank_entry, closest_score, closest_match_ind, accounts
-            )
+        print_match(
+            closest_match, bank_entry, closest_score, closest_match_ind, accounts
+        )
 
-            # More than likely no longer pending in this case. Update.
-            pending_update = closest_match["Pending"] == "Yes"
-            do_match = PROMPT_NEAR_MATCHES and input("Do these match? (y): ") == "y"
+        # More than likely no longer pending in this case. Update.
+        pending_update = closest_match["Pending"] == "Yes"
+        do_match = PROMPT_NEAR_MATCHES and input("Do these match? (y): ") == "y"
 
-            if do_match or (not PROMPT_NEAR_MATCHES and pending_update):
-                print("Updated matches")
-                matched_bank_indices.append(ind)
-                matched_sheet_indices.append(closest_match_ind)
-                sheet.update_entry(closest_match_ind, bank_entry, fields, accounts)
+        if do_match or (not PROMPT_NEAR_MATCHES and pending_update):
+            print("Updated matches")
+            matched_bank_indices.add(ind)
+            matched_sheet_indices.add(closest_match_ind)
+            sheet.update_entry(closest_match_ind, bank_entry, fields, accounts)
 
 
 def find_new_entries(sheet_entries, bank_entries, fields, accounts):
@@ -197,8 +327,9 @@ def find_new_entries(sheet_entries, bank_entries, fields, accounts):
     # Do not sort sheets as the order must match what is in the sheet
     bank_entries = sorted(bank_entries, key=entry_key)
 
-    matches = _find_perfect_matches(sheet_entries, bank_entries, fields, accounts)
-    matched_sheet_indices, matched_bank_indices, all_scores = matches
+    all_scores = _score_candidates(sheet_entries, bank_entries, accounts)
+    matches = _find_perfect_matches(sheet_entries, all_scores)
+    matched_sheet_indices, matched_bank_indices = matches
 
     _find_imperfect_matches(
         sheet_entries,
@@ -211,7 +342,7 @@ def find_new_entries(sheet_entries, bank_entries, fields, accounts):
     )
 
     all_bank_indices = set(range(len(bank_entries)))
-    unmatched_indices = all_bank_indices - set(matched_bank_indices)
+    unmatched_indices = all_bank_indices - matched_bank_indices
 
     unmatched = []
     for ind in unmatched_indices:
@@ -220,6 +351,29 @@ def find_new_entries(sheet_entries, bank_entries, fields, accounts):
     return unmatched
 
 
+def get_cutoff(sheet_entries):
+    """Get the date before which bank entries are already reconciled in the sheet.
+
+    Goes back far enough for pending rows in the sheet to be matched to their posted
+    bank entries, however old they are.
+    """
+    settled = []
+    pending = []
+    for entry in sheet_entries:
+        if isinstance(entry.get("Date"), datetime.datetime):
+            if entry.get("Pending") == "Yes":
+                pending.append(entry["Date"])
+            else:
+                settled.append(entry["Date"])
+    if not settled:
+        return None
+
+    cutoff = max(settled)
+    if pending:
+        cutoff = min(cutoff, min(pending))
+    return cutoff - datetime.timedelta(days=MATCH_RANGES["date diff"])
+
+
 def log(message):
     """Log to the log file."""
     with open(LOG_FILE, "a") as log:
@@ -228,30 +382,260 @@ def log(message):
         )
 
 
-def main():
-    """Run the program."""
-    log("START")
+def log_error(e):
+    """Log an exception with its traceback."""
+    tb = traceback.format_exception(etype=type(e), value=e, tb=e.__traceback__)
+    log("ERROR\n" + "".join(tb))
 
-    sheets_api.authorize()
 
-    accounts = sheet.get_accounts()
+def _scrape(driver, accounts, cutoff):
+    """Get the bank entries, logging in before the sheet has been read.
+
+    Parameters
+    ----------
+    driver
+        Driver from bank_website.start_session, or None to start and end one.
+    accounts
+        Future of the names of the accounts, set once they are read from the sheet.
+    cutoff
+        Future of the date to scrape from, set once the sheet entries are read.
+
+    """
+    # Imported here so matching on its own doesn't load selenium
+    import bank_website
+
+    own_driver = isinstance(driver, type(None))
+    logged_in = True
+    try:
+        with metrics.stage("log in"):
+            if own_driver:
+                driver = bank_website.start_session()
+            try:
+                # A reused driver is still on a page from the last run
+                bank_website.log_in(driver, reload=not own_driver)
+            except bank_website.UnexpectedAlertPresentException:
+                # get_entries logs in again after the alert
+                logged_in = False
+
+        accounts = accounts.result()
+        cutoff = cutoff.result()
+        with metrics.stage("scrape") as record:
+            bank_entries = bank_website.get_entries(
+                accounts, cutoff, driver, logged_in
+            )
+            record["rows"] = len(bank_entries)
+    finally:
+        if own_driver and not isinstance(driver, type(None)):
+            bank_website.end_session(driver)
+
+    return bank_entries
+
+
+def reconcile(driver=None, bank_entries=None):
+    """Add new bank entries to the sheet once.
+
+    A driver from bank_website.start_session is reused if given. Bank entries are
+    read from the files in IMPORT_DIR if set, or scraped unless given, with the
+    browser logging in while the sheet is read if CONCURRENT_SCRAPE. Returns the bank
+    entries.
+    """
+    scrape = isinstance(bank_entries, type(None)) and not IMPORT_DIR
+    accounts_read = Future()
+    cutoff_read = Future()
+
+    with ThreadPoolExecutor(1) as executor:
+        if scrape and CONCURRENT_SCRAPE:
+            scraping = executor.submit(_scrape, driver, accounts_read, cutoff_read)
+
+        try:
+            with metrics.stage("get_accounts"):
+                accounts = sheet.get_accounts()
+            accounts_read.set_result(accounts)
+
+            with metrics.stage("get_fields"):
+                sheet_fields = sheet.get_fields()
+            with metrics.stage("get_entries") as record:
+                sheet_entries = sheet.get_entries(sheet_fields, accounts)
+                record["rows"] = len(sheet_entries)
+
+            cutoff = None
+            if BOUND_SCRAPE_DATES:
+                cutoff = get_cutoff(sheet_entries)
+            cutoff_read.set_result(cutoff)
+        finally:
+            # Don't leave the scrape waiting on a read which failed
+            accounts_read.cancel()
+            cutoff_read.cancel()
+
+        if scrape and CONCURRENT_SCRAPE:
+            bank_entries = scraping.result()
+        elif scrape:
+            bank_entries = _scrape(driver, accounts_read, cutoff_read)
+
+    if isinstance(bank_entries, type(None)):
+        with metrics.stage("import") as record:
+            bank_entries = bank_files.get_entries(accounts, cutoff, IMPORT_DIR)
+            record["rows"] = len(bank_entries)
+
+    with metrics.stage("matching", rows=len(bank_entries)) as record:
+        profile = None
+        if PROFILE_FILE:
+            profile = cProfile.Profile()
+            profile.enable()
+        new_entries = find_new_entries(
+            sheet_entries, bank_entries, sheet_fields, accounts
+        )
+        if profile:
+            profile.disable()
+            profile.dump_stats(PROFILE_FILE)
+        record["new"] = len(new_entries)
+
+    with metrics.stage("writes", rows=len(new_entries)):
+        sheet.add_entries(new_entries, sheet_fields, accounts)
+        sheet.update_timestamp()
+        sheets_api.flush()
+
+    return bank_entries
 
-    sheet_fields = sheet.get_fields()
-    sheet_entries = sheet.get_entries(sheet_fields, accounts)
 
-    bank_entries = bank_website.get_entries(accounts)
+def main(record_path=None):
+    """Run the program.
 
-    new_entries = find_new_entries(sheet_entries, bank_entries, sheet_fields, accounts)
-    sheet.add_entries(new_entries, sheet_fields, accounts)
-    sheet.update_timestamp()
+    If a path is given, the bank entries and reads from the sheet are saved to it.
+    """
+    log("START")
+
+    with metrics.stage("authorize"):
+        sheets_api.authorize()
+    if record_path:
+        # Read the whole sheet so the run doesn't depend on the ledger
+        sheet.INCREMENTAL_READS = False
+        recording.start_recording()
+
+    descriptions.load()
+    bank_entries = reconcile()
+    descriptions.save()
+
+    if record_path:
+        recording.save(record_path, bank_entries)
 
     log("STOP")
 
 
+def replay(path):
+    """Rerun a recorded run without the bank or the sheet and print its writes."""
+    sheet.INCREMENTAL_READS = False
+    bank_entries = recording.start_replay(path)
+
+    reconcile(bank_entries=bank_entries)
+
+    for write in recording.writes:
+        print(*write)
+
+
+def migrate_running():
+    """Rewrite the running balances in the sheet to add to the last one."""
+    sheets_api.authorize()
+    accounts = sheet.get_accounts()
+    sheet_fields = sheet.get_fields()
+    sheet.get_entries(sheet_fields, accounts)
+    sheet.migrate_running(sheet_fields, accounts)
+    sheets_api.flush()
+
+
+def check_running():
+    """Print the rows whose running balance differs from what the old formula gives."""
+    sheets_api.authorize()
+    # Read the whole sheet so balances aren't taken from the ledger
+    sheet.INCREMENTAL_READS = False
+    accounts = sheet.get_accounts()
+    sheet_entries = sheet.get_entries(sheet.get_fields(), accounts)
+    wrong = sheet.check_running(sheet_entries, accounts)
+    for entry_num in wrong:
+        print(f"WRONG RUNNING BALANCE: ROW {sheet.get_row(entry_num)}")
+    print(f"{len(wrong)} of {len(sheet_entries)} running balances are wrong")
+
+
+def daemon():
+    """Reconcile on a schedule, keeping the browser and sheet state between runs."""
+    log("DAEMON START")
+
+    with metrics.stage("authorize"):
+        sheets_api.authorize()
+    if not IMPORT_DIR:
+        import bank_website
+    driver = None
+    descriptions.load()
+    try:
+        while True:
+            log("START")
+            try:
+                if not IMPORT_DIR and isinstance(driver, type(None)):
+                    driver = bank_website.start_session()
+                reconcile(driver)
+                descriptions.save()
+                log("STOP")
+            except Exception as e:
+                log_error(e)
+                # Don't send writes from a run which didn't finish
+                sheets_api.discard()
+                if driver:
+                    # The browser may be in any state, start over on the next run
+                    try:
+                        bank_website.end_session(driver)
+                    except Exception as end_error:
+                        log_error(end_error)
+                    driver = None
+            time.sleep(DAEMON_INTERVAL)
+    finally:
+        if driver:
+            bank_website.end_session(driver)
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--daemon", action="store_true", help="keep running and reconcile regularly"
+    )
+    parser.add_argument(
+        "--record", metavar="FILE", help="save the run so it can be replayed"
+    )
+    parser.add_argument(
+        "--replay", metavar="FILE", help="rerun a saved run without writing to the sheet"
+    )
+    parser.add_argument(
+        "--import",
+        dest="import_dir",
+        metavar="DIR",
+        help="read bank entries from exported CSV, OFX or QFX files, not the website",
+    )
+    parser.add_argument(
+        "--profile", metavar="FILE", help="dump a cProfile of matching to the file"
+    )
+    parser.add_argument(
+        "--migrate-running",
+        action="store_true",
+        help="rewrite running balances to add to the last one, once",
+    )
+    parser.add_argument(
+        "--check-running",
+        action="store_true",
+        help="check running balances against summing the whole column",
+    )
+    args = parser.parse_args()
+    PROFILE_FILE = args.profile
+    IMPORT_DIR = args.import_dir
     try:
-        main()
+        if args.daemon:
+            daemon()
+        elif args.replay:
+            replay(args.replay)
+        elif args.migrate_running:
+            migrate_running()
+        elif args.check_running:
+            check_running()
+        else:
+            main(args.record)
     except Exception as e:
-        tb = traceback.format_exception(etype=type(e), value=e, tb=e.__traceback__)
-        log("ERROR\n" + "".join(tb))
+        log_error(e)
         raise e
@@ -0,0 +1,47 @@
+"""Handle timing the stages of a run and counting the work they do."""
+import contextlib
+import datetime
+import json
+import threading
+import time
+
+METRICS_FILE = "metrics.jsonl"
+TIMESTAMP = "%Y-%m-%dT%H:%M:%S"
+
+_counters = {}
+_lock = threading.Lock()
+
+
+def count(name, amount=1):
+    """Add to a counter, such as requests made to an API."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def write(record):
+    """Write a record to the metrics file as a line of json."""
+    record = {"time": datetime.datetime.now().strftime(TIMESTAMP), **record}
+    with _lock, open(METRICS_FILE, "a") as metrics_file:
+        metrics_file.write(json.dumps(record) + "\n")
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """Time a stage of the run and record the counters it added to.
+
+    Yields the record so the stage can add fields, such as rows processed. Counters
+    added to by stages running at the same time are included in each.
+    """
+    record = {"stage": name, **fields}
+    with _lock:
+        before = dict(_counters)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = round(time.perf_counter() - start, 4)
+        with _lock:
+            for counter, value in _counters.items():
+                if value != before.get(counter, 0):
+                    record[counter] = value - before.get(counter, 0)
+        write(record)
@@ -0,0 +1,163 @@
+"""Handle recording runs and replaying them without the bank or the sheet."""
+import datetime
+import gzip
+import json
+import re
+
+import sheets_api
+
+# Functions of sheets_api which write to the sheet
+WRITE_FUNCTIONS = ("append_cells", "update_cells", "batch_update_cells")
+# Range in A1 notation, such as Sheet1!B9:B5008, Sheet1!8:8 or Sheet1!G6
+RANGE = re.compile(r"(?:(.*)!)?([A-Z]*)(\d*)(:([A-Z]*)(\d*))?")
+
+_grid = {}  # Rows of the values read from each sheet, blank where not read
+writes = []  # Writes made while replaying, in order
+
+
+def _get_column_index(letters):
+    """Get the index of a column in the sheet from its letters."""
+    column_num = 0
+    for letter in letters:
+        column_num = column_num * 26 + ord(letter) - ord("A") + 1
+    return column_num - 1
+
+
+def _parse_range(range_name):
+    """Get the sheet of a range, the row and column it starts at and where it ends.
+
+    Rows and columns count from 0. The range ends before the end row and column,
+    which are None if it goes on to the end of the sheet.
+    """
+    match = RANGE.fullmatch(range_name)
+    if not match:
+        raise ValueError(f"Can't parse range: {range_name}")
+    sheet_name, start_column, start_row, end, end_column, end_row = match.groups()
+    if not end:
+        # A single cell
+        end_column, end_row = start_column, start_row
+
+    return (
+        sheet_name or "",
+        int(start_row or 1) - 1,
+        _get_column_index(start_column or "A"),
+        int(end_row) if end_row else None,
+        _get_column_index(end_column) + 1 if end_column else None,
+    )
+
+
+def _set_values(range_name, rows):
+    """Add the rows of values read from a range to the grid."""
+    sheet_name, start_row, start_column, _, _ = _parse_range(range_name)
+    grid = _grid.setdefault(sheet_name, [])
+    for row_num, values in enumerate(rows, start_row):
+        while len(grid) <= row_num:
+            grid.append([])
+        row = grid[row_num]
+        end_column = start_column + len(values)
+        row.extend([""] * (end_column - len(row)))
+        row[start_column:end_column] = values
+
+
+def _get_values(range_name):
+    """Get the rows of values in a range of the grid, as the API returns them.
+
+    Blank cells at the end of a row and blank rows at the end are left out.
+    """
+    sheet_name, start_row, start_column, end_row, end_column = _parse_range(
+        range_name
+    )
+    rows = []
+    for grid_row in _grid.get(sheet_name, [])[start_row:end_row]:
+        row = grid_row[start_column:end_column]
+        while row and row[-1] == "":
+            row.pop()
+        rows.append(row)
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+
+def _get_column(range_name):
+    """Get the values in a single column range of the grid, as the API returns them."""
+    return [row[0] if row else "" for row in _get_values(range_name)]
+
+
+def _encode_entry(entry):
+    """Convert a bank entry to values which can be saved as json."""
+    values = dict(entry)
+    values["Date"] = values["Date"].isoformat()
+    return values
+
+
+def _decode_entry(values):
+    """Convert saved values back to a bank entry."""
+    entry = dict(values)
+    entry["Date"] = datetime.datetime.fromisoformat(entry["Date"])
+    return entry
+
+
+def start_recording():
+    """Record the values of every cell read from the sheet from now on.
+
+    Values are kept as a grid rather than by request, so a recording still replays
+    after the script changes which ranges it reads.
+    """
+    _grid.clear()
+    get_range = sheets_api.get_range
+    get_columns = sheets_api.get_columns
+
+    def _recorded_get_range(range_name):
+        rows = get_range(range_name)
+        _set_values(range_name, rows)
+        return rows
+
+    def _recorded_get_columns(range_names):
+        columns = get_columns(range_names)
+        for range_name, values in zip(range_names, columns):
+            _set_values(range_name, [[value] for value in values])
+        return columns
+
+    sheets_api.get_range = _recorded_get_range
+    sheets_api.get_columns = _recorded_get_columns
+
+
+def save(path, bank_entries):
+    """Save the recorded sheet values and the bank entries."""
+    recording = {
+        "grid": _grid,
+        "bank": [_encode_entry(entry) for entry in bank_entries],
+    }
+    with gzip.open(path, "wt") as recording_file:
+        json.dump(recording, recording_file, separators=(",", ":"))
+
+
+def start_replay(path):
+    """Answer reads from the sheet with a recording and keep writes to the sheet.
+
+    Cells which weren't read while recording are blank. Returns the recorded bank
+    entries.
+    """
+    with gzip.open(path, "rt") as recording_file:
+        recording = json.load(recording_file)
+    if "grid" not in recording:
+        raise Exception(f"Recorded by an older version, record again: {path}")
+    _grid.clear()
+    _grid.update(recording["grid"])
+    writes.clear()
+
+    def _write(function_name):
+        def _written(*args):
+            writes.append((function_name, *args))
+            return {}
+
+        return _written
+
+    sheets_api.get_range = _get_values
+    sheets_api.get_columns = lambda range_names: [
+        _get_column(range_name) for range_name in range_names
+    ]
+    for function_name in WRITE_FUNCTIONS:
+        setattr(sheets_api, function_name, _write(function_name))
+
+    return [_decode_entry(values) for values in recording["bank"]]
@@ -0,0 +1,236 @@
+"""Handle vectorized scoring of sheet entries against bank entries."""
+import itertools
+
+import descriptions
+from entries import get_amount_account
+
+np = None  # numpy, imported when first needed
+
+# Order must match the order factors are summed in main.score_match
+FACTORS = ("date diff", "account diff", "amount diff", "balance diff", "desc diff")
+
+
+def available():
+    """Determine whether vectorized scoring can be used, importing numpy if so."""
+    global np
+
+    if isinstance(np, type(None)):
+        try:
+            import numpy as np
+        except ImportError:
+            return False
+    return True
+
+
+def _get_columns(entries, defaults, get_row):
+    """Convert entries into columnar arrays, one per column in defaults.
+
+    get_row gets the values of an entry by column, or None if it cannot be
+    converted. Such entries are marked invalid and keep the defaults.
+    """
+    valid = []  # Indices of the entries which could be converted
+    values = {column: [] for column in defaults}
+    for ind, entry in enumerate(entries):
+        row = get_row(entry)
+        if isinstance(row, type(None)):
+            continue
+        valid.append(ind)
+        for column in row:
+            values[column].append(row[column])
+
+    # Set whole columns at once, which is much faster than one value at a time
+    columns = {}
+    for column, default in defaults.items():
+        columns[column] = np.full(len(entries), default)
+        columns[column][valid] = values[column]
+    columns["valid"] = np.zeros(len(entries), dtype=bool)
+    columns["valid"][valid] = True
+    return columns
+
+
+def get_sheet_columns(sheet_entries, accounts):
+    """Convert sheet entries into columnar arrays.
+
+    Entries which cannot be converted are marked invalid and must be scored one by
+    one.
+    """
+    account_ids = {account: num for num, account in enumerate(accounts)}
+
+    def _get_row(entry):
+        account = get_amount_account(entry, accounts)
+        if isinstance(account, type(None)):
+            return None
+        try:
+            amount = entry[account]
+            balance = entry[account + " Running"]
+            if not isinstance(amount, float) or not isinstance(balance, float):
+                return None
+            return {
+                "date": entry["Date"].toordinal(),
+                "account": account_ids[account],
+                "amount": amount,
+                "balance": balance,
+                "desc": descriptions.get_id(entry["Bank_Listed_Item"]),
+            }
+        except (KeyError, AttributeError):
+            return None
+
+    defaults = {"date": 0.0, "account": -1, "amount": 0.0, "balance": 0.0, "desc": -1}
+    return _get_columns(sheet_entries, defaults, _get_row)
+
+
+def get_bank_columns(bank_entries, accounts):
+    """Convert bank entries into columnar arrays.
+
+    Entries which cannot be converted are marked invalid and must be scored one by
+    one.
+    """
+
+    def _get_row(entry):
+        amount = entry["Amount"]
+        balance = entry["Balance"]
+        has_balance = balance != ""
+        if not isinstance(amount, float):
+            return None
+        if has_balance and not isinstance(balance, float):
+            return None
+        try:
+            return {
+                "date": entry["Date"].toordinal(),
+                "account": accounts.index(entry["account"]),
+                "amount": amount,
+                "balance": balance if has_balance else 0,
+                "has balance": has_balance,
+                "desc": descriptions.get_id(entry["Description"]),
+            }
+        except (ValueError, AttributeError):
+            return None
+
+    defaults = {
+        "date": 0.0,
+        "account": -1,
+        "amount": 0.0,
+        "balance": 0.0,
+        "has balance": False,
+        "desc": -1,
+    }
+    return _get_columns(bank_entries, defaults, _get_row)
+
+
+def _get_desc_diffs(sheet, bank, compare):
+    """Get how different the descriptions of each pair are.
+
+    Only pairs marked in compare have their descriptions compared, the rest count as
+    different unless equal.
+    """
+    diffs = np.where(sheet["desc"] == bank["desc"], 0.0, 1.0)
+    differ = np.flatnonzero(
+        (sheet["desc"] != bank["desc"]) & sheet["valid"] & bank["valid"] & compare
+    )
+    if len(differ):
+        diffs[differ] = descriptions.get_diffs(
+            bank["desc"][differ], sheet["desc"][differ]
+        )
+    return diffs
+
+
+def score_pairs(
+    sheet_columns, bank_columns, sheet_inds, bank_inds, weights, ranges, threshold
+):
+    """Score the bank entries at some indices against the sheet entries at others.
+
+    Returns an array with a score per pair. Pairs involving an invalid entry are nan.
+    Pairs at or above the threshold before their descriptions are compared score as
+    if the descriptions differ.
+    """
+    sheet = {column: values[sheet_inds] for column, values in sheet_columns.items()}
+    bank = {column: values[bank_inds] for column, values in bank_columns.items()}
+
+    balance_diff = bank["balance"] - sheet["balance"]
+    balance_diff[np.abs(balance_diff) < 1] = 0
+    factors = {
+        "date diff": bank["date"] - sheet["date"],
+        "account diff": bank["account"] != sheet["account"],
+        "amount diff": bank["amount"] - sheet["amount"],
+        "balance diff": np.where(bank["has balance"], balance_diff, 0),
+    }
+
+    scores = np.zeros(len(balance_diff))
+    for factor in FACTORS:
+        if factor == "desc diff":
+            # Summed last so only pairs which may still match are compared
+            factors[factor] = _get_desc_diffs(sheet, bank, scores < threshold)
+        scores += np.minimum(np.abs(factors[factor] / ranges[factor]), 1) * (
+            weights[factor] / 100
+        )
+
+    scores[~(bank["valid"] & sheet["valid"])] = np.nan
+    return scores
+
+
+def get_candidates(index, unindexed, all_keys, num_sheet_entries):
+    """Get an array of the sheet indices each bank entry may match.
+
+    As main._get_candidates, but whole buckets of the index are joined as arrays
+    rather than one index at a time. Keys are None for bank entries which can't be
+    indexed.
+    """
+    buckets = {key: np.array(inds, dtype=int) for key, inds in index.items()}
+    unindexed = np.array(unindexed, dtype=int)
+    everything = np.arange(num_sheet_entries)
+
+    all_candidates = []
+    for keys in all_keys:
+        if isinstance(keys, type(None)):
+            all_candidates.append(everything)
+            continue
+        candidates = np.concatenate(
+            [unindexed, *(buckets[key] for key in keys if key in buckets)]
+        )
+        all_candidates.append(candidates)
+    return all_candidates
+
+
+def score_candidates(
+    sheet_columns, bank_columns, all_candidates, weights, ranges, threshold, max_pairs
+):
+    """Score every bank entry against its candidate sheet entries.
+
+    Pairs are scored in vectorized chunks of about max_pairs. Returns a dict from
+    sheet index to score per bank entry, in the order of its candidates. Pairs
+    scoring at or above the threshold are left out.
+    """
+    all_scores = []
+    start = 0
+    while start < len(all_candidates):
+        # Take bank entries until the chunk is full
+        end = start
+        num_pairs = 0
+        while end < len(all_candidates) and (
+            end == start or num_pairs + len(all_candidates[end]) <= max_pairs
+        ):
+            num_pairs += len(all_candidates[end])
+            end += 1
+
+        lengths = [len(candidates) for candidates in all_candidates[start:end]]
+        bank_inds = np.repeat(np.arange(start, end), lengths)
+        sheet_inds = np.concatenate(all_candidates[start:end])
+        scores = score_pairs(
+            sheet_columns,
+            bank_columns,
+            sheet_inds,
+            bank_inds,
+            weights,
+            ranges,
+            threshold,
+        )
+
+        # Keep nan so the caller can score those pairs itself
+        keep = ~(scores >= threshold)
+        kept = zip(sheet_inds[keep].tolist(), scores[keep].tolist())
+        counts = np.bincount(bank_inds[keep] - start, minlength=end - start)
+        for count in counts.tolist():
+            all_scores.append(dict(itertools.islice(kept, count)))
+        start = end
+
+    return all_scores
@@ -1,8 +1,13 @@
 """Handle interactions with the Google Sheet."""
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import functools
 
+import categories
+import ledger
 import sheets_api
-from formatting import format_value
+from entries import Entry, MISSING, get_amount_accounts, get_columns
+from formatting import get_converter
 
 # Constants
 ACCOUNT_ROW = 1
@@ -13,12 +18,18 @@ DATE_FORMAT = "%m/%d/%Y"
 START_CELL = "$G$6"  # If changed, must recopy formula to all cells in running columns
 # TODO: just use field row instead ??
 RUNNING_FORMULA = f'=IF(ISBLANK(INDIRECT(ADDRESS(ROW(), COLUMN() - 1))), "", sum(indirect(ADDRESS({START_CELL}, COLUMN() - 1)&":"&ADDRESS(ROW(),COLUMN()-1))))'
-METHOD_WORDS = {
-    "Direct": ("deposit", "ach", "accr earning pymt"),
-    "Check": ("check", ),
-    "Card": ("pos", "debit", "card"),
-}
-METHOD_DEFAULT = "Card"
+INCREMENTAL_READS = True  # Only pull rows which may have changed since the last run
+REFRESH_DAYS = 10  # Rows this close to the newest date are always pulled again
+VERIFY_BLOCK_SIZE = 500  # Settled rows checked against the ledger per run
+INCREMENTAL_RUNNING = True  # Running balances add to the last one instead of summing
+RUNNING_TOLERANCE = 0.005  # Difference in a running balance which counts as wrong
+READ_BLOCK_SIZE = 5000  # Rows pulled per request, more than any gap of blank rows
+PARALLEL_BLOCKS = 1  # Blocks of rows pulled at the same time
+
+_refresh = None  # Index of the first entry to pull on the next run
+_entries = None  # Entries from the last read, reused when running as a daemon
+_entry_accounts = None  # Accounts with an amount in each entry, found when needed
+_start_row = None  # Value of START_CELL, pulled when first needed
 
 
 def get_fields():
@@ -43,39 +54,358 @@ def get_accounts():
     return account_row[account_row.index("Account") + 1:]
 
 
+def _get_converters(fields):
+    """Get the function which formats values of each field."""
+    return {field_name: get_converter(field_name, DATE_FORMAT) for field_name in fields}
+
+
+def _get_entry_columns(fields, accounts):
+    """Get the columns of entries, with running balances after their accounts."""
+    names = []
+    for field_name in fields:
+        names.append(field_name)
+        if field_name in accounts:
+            names.append(field_name + " Running")
+    return get_columns(names)
+
+
+def _parse_row(row, fields, accounts, converters, columns):
+    """Create an entry from the values in a sheet row."""
+    values = [MISSING] * len(columns)
+    for field_name in fields:
+        # Fill entry from values in row
+        field_num = fields[field_name]
+        if field_num >= len(row):
+            # Row ends before the extra stuff
+            continue
+        value = row[field_num]
+        values[columns[field_name]] = converters[field_name](value)
+        # Grab running balance adjacent to account
+        if field_name in accounts:
+            balance = row[fields[field_name] + 1]
+            values[columns[field_name + " Running"]] = get_converter()(balance)
+
+    return Entry(columns, values)
+
+
+def _parse_rows(rows, fields, accounts):
+    """Create entries from the values in sheet rows."""
+    converters = _get_converters(fields)
+    columns = _get_entry_columns(fields, accounts)
+    return [_parse_row(row, fields, accounts, converters, columns) for row in rows]
+
+
+def _get_column_letter(column_num):
+    """Get the letter of a column in the sheet from its index."""
+    letters = ""
+    column_num += 1
+    while column_num:
+        column_num, remainder = divmod(column_num - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
+
+
+def _get_rows(fields, accounts, start, end):
+    """Pull only the columns used by entries for rows between entry indices."""
+    columns = set(fields.values()) | {fields[account] + 1 for account in accounts}
+    columns = sorted(columns)
+    start_row = get_row(start)
+    end_row = get_row(end - 1)
+    range_names = []
+    for column in columns:
+        letter = _get_column_letter(column)
+        range_names.append(f"{SHEET_NAME}!{letter}{start_row}:{letter}{end_row}")
+    column_values = sheets_api.get_columns(range_names)
+
+    rows = []
+    for row_ind in range(max(map(len, column_values), default=0)):
+        row = []
+        for column, values in zip(columns, column_values):
+            if row_ind < len(values) and values[row_ind] != "":
+                # Rows end at their last value, pad up to this one
+                row.extend([""] * (column + 1 - len(row)))
+                row[column] = values[row_ind]
+        rows.append(row)
+
+    return rows
+
+
+def _get_entry_rows(fields, accounts, start):
+    """Pull a block of rows from an entry index, with only the columns of entries."""
+    return _get_rows(fields, accounts, start, start + READ_BLOCK_SIZE)
+
+
+def _get_row_block(start):
+    """Pull a block of whole rows from an entry index."""
+    end_row = get_row(start + READ_BLOCK_SIZE - 1)
+    return sheets_api.get_range(f"{SHEET_NAME}!{get_row(start)}:{end_row}")
+
+
+def _iter_rows(get_block, start=0):
+    """Pull rows a block at a time from an entry index, yielding each row.
+
+    Blank rows at the end of a block aren't returned by the API, so they are filled
+    in once a later block has rows. Stops at the first blank block.
+
+    Parameters
+    ----------
+    get_block
+        Function which pulls the rows of a block from the entry index it starts at.
+    start
+        Index of the first entry to pull.
+
+    """
+    with ThreadPoolExecutor(PARALLEL_BLOCKS) as executor:
+        blank = 0
+        while True:
+            starts = range(
+                start, start + PARALLEL_BLOCKS * READ_BLOCK_SIZE, READ_BLOCK_SIZE
+            )
+            for rows in executor.map(get_block, starts):
+                if not rows:
+                    return
+                for _ in range(blank):
+                    yield []
+                yield from rows
+                blank = READ_BLOCK_SIZE - len(rows)
+            start += PARALLEL_BLOCKS * READ_BLOCK_SIZE
+
+
+def iter_entries(fields, accounts):
+    """Pull and parse all entries in the sheet, yielding each entry.
+
+    Only one block of raw rows is held at a time, or PARALLEL_BLOCKS when pulling
+    blocks at the same time.
+    """
+    converters = _get_converters(fields)
+    columns = _get_entry_columns(fields, accounts)
+    for row in _iter_rows(_get_row_block):
+        yield _parse_row(row, fields, accounts, converters, columns)
+
+
+def _is_settled(entry, cutoff):
+    """Determine whether an entry can no longer be changed by a run."""
+    date = entry.get("Date")
+    return (
+        isinstance(date, datetime.datetime)
+        and date < cutoff
+        and entry.get("Pending") != "Yes"
+    )
+
+
+def _get_refresh_index(entries, start):
+    """Find the first entry which must be pulled again on the next run.
+
+    Entries before start are already settled.
+    """
+    dates = [entry.get("Date") for entry in entries[start:]]
+    dates = [date for date in dates if isinstance(date, datetime.datetime)]
+    if not dates:
+        return start
+    cutoff = max(dates) - datetime.timedelta(days=REFRESH_DAYS)
+
+    for ind in range(start, len(entries)):
+        if not _is_settled(entries[ind], cutoff):
+            return ind
+    return len(entries)
+
+
+def _is_block_unchanged(fields, accounts, start, end):
+    """Check whether the entries between two indices match the ledger."""
+    rows = _get_rows(fields, accounts, start, end)
+    # Blank rows at the end of the block are not returned
+    rows.extend([[]] * (end - start - len(rows)))
+
+    checksums = [ledger.get_checksum(row) for row in rows]
+    stored = ledger.get_stored_checksums(get_row(start), get_row(end))
+    return ledger.get_block_checksum(checksums) == ledger.get_block_checksum(stored)
+
+
+def _verify_block(fields, accounts, start):
+    """Check settled entries against the sheet.
+
+    The block just before start is checked every run, as rows inserted or removed
+    anywhere among settled entries shift it. One other block is checked in turn for
+    changed rows. Returns the index from which entries must be pulled again.
+    """
+    num_blocks = -(-start // VERIFY_BLOCK_SIZE)
+    if not num_blocks:
+        return start
+
+    last_start = max(start - VERIFY_BLOCK_SIZE, 0)
+    if not _is_block_unchanged(fields, accounts, last_start, start):
+        # Can't tell where rows were shifted from, so no index can be trusted
+        return 0
+
+    block = ledger.get_meta("verify block", 0) % num_blocks
+    ledger.set_meta("verify block", block + 1)
+    block_start = block * VERIFY_BLOCK_SIZE
+    block_end = min(block_start + VERIFY_BLOCK_SIZE, last_start)
+    if block_start < block_end and not _is_block_unchanged(
+        fields, accounts, block_start, block_end
+    ):
+        # Changed outside this script, pull everything after it again
+        return block_start
+    return start
+
+
 def get_entries(fields, accounts):
-    """Get transaction entries already in the sheet."""
-
-    # Pull all entries from sheet
-    entries = []
-    rows = sheets_api.get_range(SHEET_NAME)[FIELD_ROW:]
-
-    for row in rows:
-        entry = {}
-        for field_name in fields:
-            # Create dict from values in row
-            field_num = fields[field_name]
-            if field_num >= len(row):
-                # Row ends before the extra stuff
-                continue
-            value = row[field_num]
-            entry[field_name] = format_value(value, field_name, DATE_FORMAT)
-            # Grab running balance adjacent to account
-            if field_name in accounts:
-                balance = row[fields[field_name] + 1]
-                entry[field_name + " Running"] = format_value(balance)
-
-        # Create transaction from dict
-        entries.append(entry)
+    """Get transaction entries already in the sheet.
+
+    With incremental reads, settled entries come from the ledger and only the rest
+    are pulled from the sheet.
+    """
+    global _refresh, _entries, _entry_accounts
+
+    _entry_accounts = None
+    if not INCREMENTAL_READS:
+        # Pull all entries from sheet
+        _entries = list(iter_entries(fields, accounts))
+        return list(_entries)
+
+    ledger.connect(fields, accounts)
+    start = _verify_block(fields, accounts, ledger.get_meta("refresh", 0))
+    get_block = functools.partial(_get_entry_rows, fields, accounts)
+    # Raw rows are kept for the ledger's checksums
+    rows = list(_iter_rows(get_block, start))
+    if len(rows) < ledger.get_count() - start:
+        # Rows have been removed, the ledger can't be trusted
+        start = 0
+        rows = list(_iter_rows(get_block, start))
+
+    new_entries = _parse_rows(rows, fields, accounts)
+    ledger.replace_entries(get_row(start), new_entries, rows, accounts)
+
+    if not isinstance(_entries, type(None)):
+        # Already read settled entries in this process
+        entries = _entries[:start]
+    else:
+        columns = _get_entry_columns(fields, accounts)
+        entries = [
+            Entry.from_dict(columns, values)
+            for values in ledger.get_entries(get_row(start))
+        ]
+    entries.extend(new_entries)
+
+    _refresh = _get_refresh_index(entries, start)
+    ledger.set_meta("refresh", _refresh)
+    _entries = list(entries)
 
     return entries
 
 
+def _refresh_entry(entry_num):
+    """Ensure an entry is pulled again on the next run after it is changed."""
+    global _refresh
+
+    if isinstance(_refresh, type(None)) or entry_num >= _refresh:
+        return
+    _refresh = entry_num
+    ledger.set_meta("refresh", _refresh)
+
+
 def get_row(entry_index):
     """Return the row in the sheet which corresponds to a given index."""
     return entry_index + FIELD_ROW + 1
 
 
+def _get_entry_accounts(accounts):
+    """Get the accounts of each entry from the last read, finding them once."""
+    global _entry_accounts
+
+    if isinstance(_entry_accounts, type(None)):
+        _entry_accounts = [
+            get_amount_accounts(entry, accounts) for entry in _entries
+        ]
+    return _entry_accounts
+
+
+def _get_start_index():
+    """Get the index of the entry in the first row summed into running balances."""
+    global _start_row
+
+    if isinstance(_start_row, type(None)):
+        cell = START_CELL.replace("$", "")
+        value = sheets_api.get_range(f"{SHEET_NAME}!{cell}")[0][0]
+        _start_row = int(get_converter()(value))
+    return _start_row - get_row(0)
+
+
+def _find_entry(account, start, step, accounts):
+    """Find the nearest entry of an account from an index, going by step, or None."""
+    entry_accounts = _get_entry_accounts(accounts)
+    ind = start
+    while max(_get_start_index(), 0) <= ind < len(entry_accounts):
+        if account in entry_accounts[ind]:
+            return ind
+        ind += step
+    return None
+
+
+def _get_running_formula(entry_num, account, fields, accounts):
+    """Get the formula adding an entry's amount to the last balance of its account.
+
+    Entries before the start row keep RUNNING_FORMULA.
+    """
+    if entry_num < _get_start_index():
+        return RUNNING_FORMULA
+
+    amount = f"{_get_column_letter(fields[account])}{get_row(entry_num)}"
+    previous = _find_entry(account, entry_num - 1, -1, accounts)
+    if isinstance(previous, type(None)):
+        return f'=IF(ISBLANK({amount}), "", {amount})'
+    running = f"{_get_column_letter(fields[account] + 1)}{get_row(previous)}"
+    return f'=IF(ISBLANK({amount}), "", {amount} + {running})'
+
+
+def _set_entry_account(entry_num, account, fields, accounts):
+    """Record the account of an entry, returning the formula for its running balance.
+
+    The entry is left with an amount in that account only. The next entries of each
+    account it gained or lost are made to add to the right running balance. Writes
+    are buffered.
+    """
+    entry_accounts = _get_entry_accounts(accounts)
+    old_accounts = entry_accounts[entry_num]
+    entry_accounts[entry_num] = (account,)
+
+    for changed_account in (*old_accounts, account):
+        if (changed_account in old_accounts) == (changed_account == account):
+            # Kept its amount in this account, or never had one
+            continue
+        next_num = _find_entry(changed_account, entry_num + 1, 1, accounts)
+        if isinstance(next_num, type(None)):
+            continue
+        letter = _get_column_letter(fields[changed_account] + 1)
+        formula = _get_running_formula(next_num, changed_account, fields, accounts)
+        sheets_api.buffer_update(
+            f"{SHEET_NAME}!{letter}{get_row(next_num)}", [[formula]]
+        )
+
+    return _get_running_formula(entry_num, account, fields, accounts)
+
+
+def _append_entry_account(account, fields, accounts):
+    """Record an entry appended after the last one.
+
+    The running balance refers to the entry's own row, so returns a function which
+    writes it once given the row the entry was appended to. Writes are buffered.
+    """
+    entry_accounts = _get_entry_accounts(accounts)
+    entry_accounts.append((account,))
+    appended_num = len(entry_accounts) - 1
+    letter = _get_column_letter(fields[account] + 1)
+
+    def _write_running(row):
+        if isinstance(row, type(None)):
+            # Not known, such as when replaying, so after the last entry
+            row = get_row(appended_num)
+        formula = _get_running_formula(row - get_row(0), account, fields, accounts)
+        sheets_api.buffer_update(f"{SHEET_NAME}!{letter}{row}", [[formula]])
+
+    return _write_running
+
+
 def update_entry(entry_num, bank_entry, fields, accounts):
     """Update the entry in Google Sheets with differing info in the bank entry.
 
@@ -84,6 +414,10 @@ def update_entry(entry_num, bank_entry, fields, accounts):
     entry_num
         None if append to end. Else, row of entry to update.
 
+    Writes are buffered until sheets_api.flush is called. With INCREMENTAL_RUNNING,
+    the running balance of an appended entry is written once the append says which
+    row it landed in.
+
     """
     values = []
 
@@ -99,28 +433,25 @@ def update_entry(entry_num, bank_entry, fields, accounts):
         else:
             values.append(None)
 
+    on_append = None
+    if INCREMENTAL_RUNNING:
+        if isinstance(entry_num, type(None)):
+            values[running_index] = None
+            on_append = _append_entry_account(bank_entry["account"], fields, accounts)
+        else:
+            values[running_index] = _set_entry_account(
+                entry_num, bank_entry["account"], fields, accounts
+            )
+
     # Indexed from 0, add one for first row
     if not isinstance(entry_num, type(None)):
+        _refresh_entry(entry_num)
         row = get_row(entry_num)
-        sheets_api.update_cells(f"{SHEET_NAME}!A{row}", [values])
+        sheets_api.buffer_update(f"{SHEET_NAME}!A{row}", [values])
     else:
         # Point to first row of table, google sheets api will append to end
         row = FIELD_ROW + 1
-        sheets_api.append_cells(f"{SHEET_NAME}!A{row}", [values])
-
-
-def _get_method(description):
-    """Determine the method of payment based on the description."""
-    for method in METHOD_WORDS:
-        for word in METHOD_WORDS[method]:
-            if word in description:
-                return method
-    return METHOD_DEFAULT
-
-
-def _get_paypal(description):
-    """Determine whether payment made via paypal based on description."""
-    return ("No", "Yes")["paypal" in description]
+        sheets_api.buffer_append(f"{SHEET_NAME}!A{row}", [values], on_append)
 
 
 def get_value(bank_entry, sheet_field, accounts):
@@ -128,7 +459,6 @@ def get_value(bank_entry, sheet_field, accounts):
 
     Maps sheet fields to bank fields.
     """
-    desc = bank_entry["Description"].lower()
     if sheet_field == "Date":
         return bank_entry["Date"].strftime(DATE_FORMAT)
     elif sheet_field in accounts:
@@ -138,10 +468,9 @@ def get_value(bank_entry, sheet_field, accounts):
             return ""
     elif sheet_field == "Bank_Listed_Item":
         return bank_entry["Description"]
-    elif sheet_field == "Method":
-        return _get_method(desc)
-    elif sheet_field == "PayPal":
-        return _get_paypal(desc)
+    elif sheet_field in categories.get_fields():
+        # Fields such as Method and PayPal, see categories.RULES
+        return categories.classify(bank_entry["Description"])[sheet_field]
     elif sheet_field == "In_Account":
         return "Yes"
     elif sheet_field == "Pending":
@@ -168,7 +497,7 @@ def add_bank_balance(amount, account, accounts):
     row = ACCOUNT_ROW + REPORTED_OFFSET
     values = [None] * len(accounts)
     values[accounts.index(account)] = amount
-    sheets_api.update_cells(f"{SHEET_NAME}!B{row}", [values])
+    sheets_api.buffer_update(f"{SHEET_NAME}!B{row}", [values])
 
 
 def add_entries(entries, fields, accounts):
@@ -181,4 +510,64 @@ def add_entries(entries, fields, accounts):
 def update_timestamp():
     """Update the timestamp on the sheet."""
     timestamp = datetime.datetime.now().strftime("%m/%d/%Y %I:%M:%S %p")
-    sheets_api.update_cells(f"{SHEET_NAME}!B{FIELD_ROW - 1}", [[timestamp]])
+    sheets_api.buffer_update(f"{SHEET_NAME}!B{FIELD_ROW - 1}", [[timestamp]])
+
+
+def migrate_running(fields, accounts):
+    """Rewrite the running balances of every entry to add to the last one.
+
+    Run once after turning on INCREMENTAL_RUNNING so existing rows stop summing the
+    whole column. Running balances of accounts an entry has no amount in are
+    cleared. Needs the entries from get_entries. Writes are buffered.
+    """
+    start = max(_get_start_index(), 0)
+    entry_accounts = _get_entry_accounts(accounts)
+    for account in accounts:
+        letter = _get_column_letter(fields[account] + 1)
+        for block_start in range(start, len(entry_accounts), READ_BLOCK_SIZE):
+            block_end = min(block_start + READ_BLOCK_SIZE, len(entry_accounts))
+            values = []
+            for entry_num in range(block_start, block_end):
+                if account in entry_accounts[entry_num]:
+                    values.append(
+                        [_get_running_formula(entry_num, account, fields, accounts)]
+                    )
+                else:
+                    values.append([""])
+            range_name = (
+                f"{SHEET_NAME}!{letter}{get_row(block_start)}:"
+                f"{letter}{get_row(block_end - 1)}"
+            )
+            sheets_api.buffer_update(range_name, values)
+
+
+def check_running(entries, accounts):
+    """Find entries with a running balance other than what RUNNING_FORMULA gives.
+
+    RUNNING_FORMULA sums the amounts in the account's column from the start row to the
+    entry's row. Returns the indices of the entries.
+    """
+    start = max(_get_start_index(), 0)
+    # Sum of the amounts of each account before each entry
+    sums = {account: [0] for account in accounts}
+    for entry in entries:
+        for account in accounts:
+            amount = entry.get(account, "")
+            amount = amount if isinstance(amount, float) else 0
+            sums[account].append(sums[account][-1] + amount)
+
+    wrong = []
+    for entry_num, entry in enumerate(entries):
+        # The range summed is flipped for entries before the start row
+        first, last = sorted((start, entry_num))
+        for account in get_amount_accounts(entry, accounts):
+            expected = sums[account][last + 1] - sums[account][first]
+            balance = entry.get(account + " Running")
+            if (
+                not isinstance(balance, float)
+                or abs(balance - expected) > RUNNING_TOLERANCE
+            ):
+                wrong.append(entry_num)
+                break
+
+    return wrong
@@ -1,55 +1,235 @@
 """Handle Google Sheet API and functionality."""
 from __future__ import print_function
-from googleapiclient.discovery import build
-from httplib2 import Http
-from oauth2client import file, client, tools
+import json
+import os
+import random
+import re
+import threading
+import time
+
+from files import atomic_write
+import metrics
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = "https://www.googleapis.com/auth/spreadsheets"
+SHEET_ID_FILE = "sheet_ID.txt"
+DISCOVERY_URL = "https://sheets.googleapis.com/$discovery/rest?version=v4"
+# Delete to pick up changes to the API
+DISCOVERY_FILE = "sheets_discovery.json"
+
+WRITE_CHUNK_SIZE = 500  # Max rows appended or ranges updated per request
+REQUESTS_PER_MINUTE = 60  # Sheets API quota of requests per minute for each user
+BURST_REQUESTS = 10  # Requests sent at once before waiting for the quota
+MAX_RETRIES = 5  # Times a failed request is sent again before giving up
+RETRY_DELAY = 1  # Seconds to wait before the first retry, doubled for each one
+MAX_RETRY_DELAY = 32  # Seconds
+HTTP_TIMEOUT = 60  # Seconds to wait for a response before the request fails
+RETRY_STATUSES = (500, 502, 503, 504)  # Server errors retried for idempotent requests
+RATE_LIMIT_STATUS = 429  # Rejected before being carried out, so always retried
 
-# The ID and range of a sample spreadsheet.
-with open("sheet_ID.txt") as sheet_file:
-    SPREADSHEET_ID = sheet_file.read().strip("\n")
+# The ID of the spreadsheet, read when authorizing
+SPREADSHEET_ID = None
 
 service = None
+_authorize_http = None  # Creates a new authorized connection, set when authorizing
+_local = threading.local()  # Connection of each thread other than the main one
+_quota_lock = threading.Lock()
+_quota = BURST_REQUESTS  # Requests which can be sent now, negative if waited for
+_quota_time = time.monotonic()
+# Writes waiting to be flushed
+_buffered_updates = []
+_buffered_appends = {}
+_append_callbacks = {}  # Called with the row each buffered append landed in
+
+
+def _get_discovery_document(http):
+    """Get the description of the Sheets API, downloading it only once."""
+    if not os.path.exists(DISCOVERY_FILE):
+        response, content = http.request(DISCOVERY_URL)
+        if response.status != 200:
+            raise Exception(f"Could not download Sheets API: {response.status}")
+        with atomic_write(DISCOVERY_FILE, "wb") as discovery_file:
+            discovery_file.write(content)
+
+    with open(DISCOVERY_FILE) as discovery_file:
+        return discovery_file.read()
 
 
 def authorize():
     """Authorize the script to access the sheet."""
-    global service
+    # Imported here so using the rest of the script doesn't load them
+    from httplib2 import Http
+    from oauth2client import file, client, tools
+
+    with open(SHEET_ID_FILE) as sheet_file:
+        spreadsheet_id = sheet_file.read().strip("\n")
 
     store = file.Storage("token.json")
     creds = store.get()
     if not creds or creds.invalid:
         flow = client.flow_from_clientsecrets("credentials.json", SCOPES)
         creds = tools.run_flow(flow, store)
-    service = build("sheets", "v4", http=creds.authorize(Http()))
+    connect(lambda: creds.authorize(Http(timeout=HTTP_TIMEOUT)), spreadsheet_id)
+
+
+def connect(authorize_http, spreadsheet_id, api_root=None):
+    """Connect to the API to access a spreadsheet.
+
+    Parameters
+    ----------
+    authorize_http
+        Function creating a new authorized connection. Each connection keeps its
+        sockets open between requests.
+    spreadsheet_id
+        The ID of the spreadsheet.
+    api_root
+        URL requests are sent to instead of Google's, such as a local fake server.
+
+    """
+    global service, SPREADSHEET_ID, _authorize_http
+
+    from googleapiclient.discovery import build_from_document
+    from httplib2 import Http
+
+    SPREADSHEET_ID = spreadsheet_id
+    _authorize_http = authorize_http
+    client_options = None
+    if not isinstance(api_root, type(None)):
+        client_options = {"api_endpoint": api_root}
+    service = build_from_document(
+        _get_discovery_document(Http(timeout=HTTP_TIMEOUT)),
+        http=_authorize_http(),
+        client_options=client_options,
+    )
+
+
+def _get_http():
+    """Get the connection requests from this thread are sent with.
+
+    Connections can't be shared between threads, so threads other than the main
+    one each get their own. None means the service's own connection.
+    """
+    if threading.current_thread() is threading.main_thread():
+        return None
+    if not hasattr(_local, "http"):
+        _local.http = _authorize_http()
+    return _local.http
+
+
+def _wait_for_quota():
+    """Wait until a request can be sent without going over the quota.
+
+    The quota refills at REQUESTS_PER_MINUTE and holds up to BURST_REQUESTS. Each
+    request takes its turn from it before waiting, so threads wait in order.
+    """
+    global _quota, _quota_time
+
+    with _quota_lock:
+        now = time.monotonic()
+        refilled = (now - _quota_time) * REQUESTS_PER_MINUTE / 60
+        _quota = min(BURST_REQUESTS, _quota + refilled) - 1
+        _quota_time = now
+        wait = -_quota * 60 / REQUESTS_PER_MINUTE if _quota < 0 else 0
+    if wait > 0:
+        metrics.count("sheets quota seconds", wait)
+        time.sleep(wait)
+
+
+def _get_retry_delay(error, retry, idempotent):
+    """Get the seconds to wait before retrying a failed request, or None to give up.
+
+    Requests rejected by the rate limit are always retried. Server errors, timeouts
+    and lost connections are only retried for requests which can safely be carried
+    out twice, since the first one may have been.
+    """
+    if retry >= MAX_RETRIES:
+        return None
+    response = getattr(error, "resp", None)
+    status = getattr(response, "status", None)
+    if status == RATE_LIMIT_STATUS:
+        retry_after = response.get("retry-after", "")
+        if retry_after.isdigit():
+            return int(retry_after)
+    elif not idempotent:
+        return None
+    elif isinstance(status, type(None)):
+        from httplib2 import HttpLib2Error
+
+        # Before Python 3.10 socket.timeout isn't a TimeoutError, only an OSError
+        if not isinstance(error, (OSError, HttpLib2Error)):
+            return None
+    elif status not in RETRY_STATUSES:
+        return None
+    # Random so threads that failed together don't retry together
+    return random.uniform(0, min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** retry))
+
+
+def _execute(request, idempotent=True):
+    """Send a request to the API, counting the requests and bytes sent and received.
+
+    Failed requests are retried with growing delays, see _get_retry_delay.
+    """
+    retry = 0
+    while True:
+        _wait_for_quota()
+        metrics.count("sheets requests")
+        try:
+            result = request.execute(http=_get_http())
+            break
+        except Exception as error:
+            delay = _get_retry_delay(error, retry, idempotent)
+            if isinstance(delay, type(None)):
+                raise
+            metrics.count("sheets retries")
+            time.sleep(delay)
+            retry += 1
+
+    metrics.count("sheets bytes", len(request.body or "") + len(json.dumps(result)))
+    return result
 
 
 def get_range(range_name):
     """Return a range of values."""
-    result = (
+    result = _execute(
         service.spreadsheets()
         .values()
         .get(spreadsheetId=SPREADSHEET_ID, range=range_name)
-        .execute()
     )
     return result.get("values", [])
 
 
+def get_columns(range_names):
+    """Return the values of many single column ranges in a single request."""
+    result = _execute(
+        service.spreadsheets()
+        .values()
+        .batchGet(
+            spreadsheetId=SPREADSHEET_ID, ranges=range_names, majorDimension="COLUMNS"
+        )
+    )
+    # Blank ranges are returned without values
+    return [
+        value_range.get("values", [[]])[0]
+        for value_range in result.get("valueRanges", [])
+    ]
+
+
 def append_cells(range_name, values):
     """Append values to cells in the given range."""
     body = {"values": values}
-    result = (
+    result = _execute(
         service.spreadsheets()
         .values()
         .append(
             spreadsheetId=SPREADSHEET_ID,
             range=range_name,
             valueInputOption="USER_ENTERED",
+            # Add rows rather than fill blank ones, so the sheet grows as needed
+            insertDataOption="INSERT_ROWS",
             body=body,
-        )
-        .execute()
+        ),
+        # Appending twice would duplicate the rows
+        idempotent=False,
     )
     return result
 
@@ -57,7 +237,7 @@ def append_cells(range_name, values):
 def update_cells(range_name, values):
     """Update values for cells in the given range."""
     body = {"values": values}
-    result = (
+    result = _execute(
         service.spreadsheets()
         .values()
         .update(
@@ -66,6 +246,85 @@ def update_cells(range_name, values):
             valueInputOption="USER_ENTERED",
             body=body,
         )
-        .execute()
     )
     return result
+
+
+def batch_update_cells(data):
+    """Update values for cells in many ranges in a single request.
+
+    Parameters
+    ----------
+    data
+        List of dicts with the range name and values for each range.
+
+    """
+    body = {"valueInputOption": "USER_ENTERED", "data": data}
+    result = _execute(
+        service.spreadsheets()
+        .values()
+        .batchUpdate(spreadsheetId=SPREADSHEET_ID, body=body)
+    )
+    return result
+
+
+def buffer_update(range_name, values):
+    """Queue an update of cells in the given range until the next flush."""
+    _buffered_updates.append({"range": range_name, "values": values})
+
+
+def buffer_append(range_name, values, on_append=None):
+    """Queue appending values to cells in the given range until the next flush.
+
+    If given, on_append is called with the row the first of the values was appended
+    to, or None if the response doesn't say. It may buffer more writes, which are
+    sent by the same flush.
+    """
+    _buffered_appends.setdefault(range_name, []).extend(values)
+    callbacks = _append_callbacks.setdefault(range_name, [])
+    callbacks.extend([on_append] + [None] * (len(values) - 1))
+
+
+def _get_appended_row(result):
+    """Get the row the first of some appended values landed in, or None if unknown."""
+    updated_range = result.get("updates", {}).get("updatedRange", "")
+    match = re.fullmatch(r".*![A-Z]*(\d+)(:.*)?", updated_range)
+    if not match:
+        return None
+    return int(match[1])
+
+
+def flush(chunk_size=None):
+    """Send all buffered writes with as few requests as possible.
+
+    Writes are removed from the buffer as they are sent so a failed flush can be
+    retried without duplicating rows.
+    """
+    if isinstance(chunk_size, type(None)):
+        chunk_size = WRITE_CHUNK_SIZE
+
+    for range_name in list(_buffered_appends):
+        values = _buffered_appends[range_name]
+        callbacks = _append_callbacks[range_name]
+        while values:
+            row = _get_appended_row(append_cells(range_name, values[:chunk_size]))
+            sent_callbacks = callbacks[:chunk_size]
+            del values[:chunk_size]
+            del callbacks[:chunk_size]
+            for offset, on_append in enumerate(sent_callbacks):
+                if not isinstance(on_append, type(None)):
+                    on_append(row if isinstance(row, type(None)) else row + offset)
+        del _buffered_appends[range_name]
+        del _append_callbacks[range_name]
+
+    while _buffered_updates:
+        chunk = _buffered_updates[:chunk_size]
+        batch_update_cells(chunk)
+        del _buffered_updates[:chunk_size]
+
+
+def discard():
+    """Drop all buffered writes without sending them."""
+    _buffered_updates.clear()
+    _buffered_appends.clear()
+    _append_callbacks.clear()
@@ -0,0 +1,64 @@
+"""Check reading exported files, including files which aren't exports."""
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+
+import bank_files
+import metrics
+
+ACCOUNTS = ["Checking", "Savings"]
+# Files in the export directory by name
+FILES = {
+    "checking.csv": (
+        "Status,Date,Description,Amount,Balance\n"
+        "Posted,01/02/2001,POS PURCHASE,-4.99,100.00\n"
+        "Pending,01/03/2001,DEPOSIT,\"$1,500.00\",\n"
+    ),
+    "notes.csv": "Remember to check the savings account\n",
+    "empty.csv": "",
+    "export.csv": "Date,Description,Amount\n01/02/2001,TRANSFER,10\n",
+}
+
+
+class GetEntriesTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        for name, text in FILES.items():
+            with open(os.path.join(self.directory, name), "w") as export_file:
+                export_file.write(text)
+
+        metrics_file = os.path.join(self.directory, "metrics.jsonl")
+        self.addCleanup(setattr, metrics, "METRICS_FILE", metrics.METRICS_FILE)
+        metrics.METRICS_FILE = metrics_file
+
+    def _get_records(self):
+        with open(metrics.METRICS_FILE) as metrics_file:
+            records = [json.loads(line) for line in metrics_file]
+        return {record["file"]: record for record in records}
+
+    def test_other_files_skipped(self):
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            entries = bank_files.get_entries(ACCOUNTS, directory=self.directory)
+
+        self.assertEqual(
+            [(entry["Description"], entry["Amount"]) for entry in entries],
+            [("POS PURCHASE", -4.99), ("DEPOSIT", 1500.0)],
+        )
+        self.assertEqual({entry["account"] for entry in entries}, {"Checking"})
+
+        records = self._get_records()
+        self.assertEqual(records["checking.csv"]["rows"], 2)
+        self.assertNotIn("skipped", records["checking.csv"])
+        for name in ("notes.csv", "empty.csv", "export.csv"):
+            self.assertIn("skipped", records[name])
+            self.assertNotIn("rows", records[name])
+            self.assertIn(name, output.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
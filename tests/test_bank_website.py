@@ -0,0 +1,203 @@
+"""Check scraping a local fake bank with a real browser, if one can be started."""
+import http.server
+import json
+import os
+import tempfile
+import threading
+import unittest
+import urllib.parse
+
+import metrics
+import sheets_api
+
+try:
+    import bank_website
+    from selenium.common.exceptions import WebDriverException
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.ui import WebDriverWait
+except ImportError:
+    bank_website = None
+
+SESSION = "fake-session"  # Cookie the fake bank logs browsers in with
+USERNAME = "user"
+PASSWORD = "password"
+# Transactions of each account, as cells of the bank's table
+TRANSACTIONS = {
+    "Checking": (
+        ("Pending transaction", "Jan 03, 2001", "DEPOSIT", "$1,500.00", ""),
+        ("Posted transaction", "Jan 02, 2001", "POS PURCHASE", "-$4.99", "$95.01"),
+    ),
+    "Savings": (
+        ("Posted transaction", "Jan 01, 2001", "INTEREST", "$0.10", "$200.10"),
+    ),
+    "Credit": (
+        ("Posted transaction", "Jan 02, 2001", "COFFEE", "-$3.50", "-$3.50"),
+    ),
+}
+LOGIN_PAGE = """<html><body><form method="post" action="/login">
+<input name="username"><input name="password" type="password">
+<button type="submit">Log in</button></form></body></html>"""
+
+
+class FakeBank(http.server.ThreadingHTTPServer):
+    """A bank which logs in on one host and shows accounts on another.
+
+    Logging in at localhost sets the session cookie for 127.0.0.1, as banks
+    with a separate login site do. Pages of the accounts are only shown with
+    the cookie. Requests to the login page are counted.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeBankHandler)
+        self.login_requests = 0
+
+    def get_url(self, host, path):
+        return f"http://{host}:{self.server_port}{path}"
+
+
+class FakeBankHandler(http.server.BaseHTTPRequestHandler):
+    def _send(self, status, body="", headers=()):
+        self.send_response(status)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body.encode())))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def _get_account_page(self, account):
+        rows = "".join(
+            "<tr>" + "".join(f"<td>{cell}</td>" for cell in cells) + "</tr>"
+            for cells in TRANSACTIONS[account]
+        )
+        return (
+            f'<html><body><div class="h2">$100.00</div>'
+            '<table id="table--transactions">'
+            "<thead><tr><th>Date</th></tr><tr><th>Description</th></tr></thead>"
+            f"<tbody>{rows}</tbody></table></body></html>"
+        )
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        logged_in = f"session={SESSION}" in self.headers.get("Cookie", "")
+        if url.path == "/login":
+            self.server.login_requests += 1
+        if url.path == "/session":
+            # Sets the cookie on the host of the accounts
+            self._send(302, headers=(
+                ("Set-Cookie", f"session={SESSION}; Path=/"),
+                ("Location", "/accounts"),
+            ))
+        elif url.path == "/login" or not logged_in:
+            self._send(200, LOGIN_PAGE)
+        elif url.path == "/accounts":
+            links = "".join(
+                f'<p><a href="/account/{account}">{account} ...1234</a></p>'
+                for account in TRANSACTIONS
+            )
+            self._send(200, f"<html><body>{links}</body></html>")
+        else:
+            self._send(200, self._get_account_page(url.path.split("/")[-1]))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode())
+        self.server.login_requests += 1
+        if form == {"username": [USERNAME], "password": [PASSWORD]}:
+            location = self.server.get_url("127.0.0.1", "/session")
+            self._send(302, headers=(("Location", location),))
+        else:
+            self._send(200, LOGIN_PAGE)
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipIf(bank_website is None, "selenium isn't installed")
+class ProcessAccountsTest(unittest.TestCase):
+    def setUp(self):
+        self.bank = FakeBank()
+        thread = threading.Thread(target=self.bank.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.bank.server_close)
+        self.addCleanup(self.bank.shutdown)
+        self.info = {
+            "url": self.bank.get_url("localhost", "/login"),
+            "username": USERNAME,
+            "password": PASSWORD,
+        }
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(setattr, metrics, "METRICS_FILE", metrics.METRICS_FILE)
+        metrics.METRICS_FILE = os.path.join(directory.name, "metrics.jsonl")
+        self.addCleanup(sheets_api.discard)
+        for name, file_name in (
+            ("BANK_INFO", "bank_info.json"),
+            ("COOKIE_FILE", "cookies.json"),
+        ):
+            self.addCleanup(setattr, bank_website, name, getattr(bank_website, name))
+            setattr(bank_website, name, os.path.join(directory.name, file_name))
+        with open(bank_website.BANK_INFO, "w") as info_file:
+            json.dump(self.info, info_file)
+
+        try:
+            self.driver = bank_website._get_driver(self.info, True)
+        except WebDriverException as error:
+            self.skipTest(f"Chrome can't be started: {error.msg}")
+        self.addCleanup(self.driver.quit)
+
+    def _log_in(self):
+        bank_website._login(self.driver, self.info)
+        WebDriverWait(self.driver, 10).until(EC.url_contains("/accounts"))
+
+    def _get_transactions(self, entries):
+        return sorted(
+            (entry["account"], entry["Description"]) for entry in entries
+        )
+
+    def test_copy_session(self):
+        self._log_in()
+        driver = bank_website._copy_session(
+            self.driver.get_cookies(), self.driver.current_url, self.info
+        )
+        try:
+            self.assertTrue(bank_website._is_logged_in(driver))
+            self.assertEqual(driver.current_url, self.driver.current_url)
+        finally:
+            driver.quit()
+
+    def test_parallel(self):
+        self._log_in()
+        self.addCleanup(
+            setattr, bank_website, "PARALLEL_ACCOUNTS", bank_website.PARALLEL_ACCOUNTS
+        )
+        bank_website.PARALLEL_ACCOUNTS = 2
+
+        entries = bank_website._process_accounts_parallel(
+            self.driver, list(TRANSACTIONS), self.info
+        )
+
+        self.assertEqual(
+            self._get_transactions(entries),
+            sorted(
+                (account, cells[2])
+                for account, transactions in TRANSACTIONS.items()
+                for cells in transactions
+            ),
+        )
+
+    def test_get_entries_logged_in(self):
+        self._log_in()
+        login_requests = self.bank.login_requests
+
+        entries = bank_website.get_entries(
+            list(TRANSACTIONS), driver=self.driver, logged_in=True
+        )
+
+        self.assertEqual(len(entries), 4)
+        self.assertEqual(self.bank.login_requests, login_requests)
+
+
+if __name__ == "__main__":
+    unittest.main()
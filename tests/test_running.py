@@ -0,0 +1,199 @@
+"""Check incremental running balances against a sheet which evaluates formulas."""
+import datetime
+import itertools
+import random
+import re
+import unittest
+
+import sheet
+import sheets_api
+from benchmarks import synthetic
+from formatting import format_value
+from recording import _get_column_index
+
+START_ROW = 20  # Row in START_CELL, where RUNNING_FORMULA starts summing
+TRANSFER_EVERY = 20  # Entries between transfers with an amount in two accounts
+# Formula written by incremental running balances
+INCREMENTAL_FORMULA = re.compile(
+    r'=IF\(ISBLANK\(([A-Z]+)(\d+)\), "", \1\2(?: \+ ([A-Z]+)(\d+))?\)'
+)
+
+
+def _get_number(value):
+    """Get the number shown in a cell, or 0 if it isn't one."""
+    value = format_value(value)
+    return value if isinstance(value, float) else 0
+
+
+class FakeSheet:
+    """A sheet which works out the running balance formulas written to it.
+
+    Like the real sheet, cells past the last row can't be written to without
+    appending rows first.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def _evaluate(self):
+        """Get the rows as they are shown, with formulas worked out."""
+        shown = [list(row) for row in self.rows]
+        for account in synthetic.ACCOUNTS:
+            column = synthetic.FIELDS.index(account + " Running")
+            amounts = [
+                _get_number(row[column - 1]) if column < len(row) else 0
+                for row in self.rows
+            ]
+            sums = [0, *itertools.accumulate(amounts)]
+            for row_num in range(sheet.FIELD_ROW, len(self.rows)):
+                row = shown[row_num]
+                if column >= len(row):
+                    continue
+                formula = row[column]
+                if row[column - 1] == "" and formula.startswith("="):
+                    row[column] = ""
+                elif formula == sheet.RUNNING_FORMULA:
+                    # Summed from the start row, flipped for rows before it
+                    first, last = sorted((START_ROW - 1, row_num))
+                    row[column] = str(sums[last + 1] - sums[first])
+                elif formula.startswith("="):
+                    match = INCREMENTAL_FORMULA.fullmatch(formula)
+                    assert match, formula
+                    assert _get_column_index(match[1]) == column - 1, formula
+                    assert int(match[2]) == row_num + 1, formula
+                    balance = amounts[row_num]
+                    if match[3]:
+                        previous = shown[int(match[4]) - 1][_get_column_index(match[3])]
+                        balance += float(previous)
+                    row[column] = str(balance)
+        return shown
+
+    def get_range(self, range_name):
+        """Get the values shown in a range of whole rows or in a single cell."""
+        shown = self._evaluate()
+        match = re.fullmatch(r".*!(\d+):(\d+)", range_name)
+        if match:
+            rows = [
+                row[:len(row) - len(list(itertools.takewhile("".__eq__, row[::-1])))]
+                for row in shown[int(match[1]) - 1:int(match[2])]
+            ]
+            while rows and not rows[-1]:
+                rows.pop()
+            return rows
+        match = re.fullmatch(r".*!([A-Z]+)(\d+)", range_name)
+        row = shown[int(match[2]) - 1]
+        column = _get_column_index(match[1])
+        return [[row[column]]] if column < len(row) else [[]]
+
+    def _write(self, row_num, column, values):
+        for value in values:
+            row = self.rows[row_num]
+            if not isinstance(value, type(None)):
+                row.extend([""] * (column + 1 - len(row)))
+                row[column] = value if isinstance(value, str) else str(value)
+            column += 1
+
+    def batch_update_cells(self, data):
+        """Write values to ranges, which must be within the rows of the sheet."""
+        for value_range in data:
+            match = re.fullmatch(r".*!([A-Z]+)(\d+)(:[A-Z]+\d+)?", value_range["range"])
+            column, row_num = _get_column_index(match[1]), int(match[2]) - 1
+            for offset, values in enumerate(value_range["values"]):
+                if row_num + offset >= len(self.rows):
+                    raise Exception("Range exceeds grid limits")
+                self._write(row_num + offset, column, values)
+        return {}
+
+    def append_cells(self, range_name, values):
+        """Insert rows after the last row with values, as an append does."""
+        row_num = len(self.rows)
+        while not any(self.rows[row_num - 1]):
+            row_num -= 1
+        for offset, row_values in enumerate(values):
+            self.rows.insert(row_num + offset, [])
+            self._write(row_num + offset, 0, row_values)
+        return {"updates": {"updatedRange": f"Sheet1!A{row_num + 1}:L{row_num + 2}"}}
+
+
+class RunningTest(unittest.TestCase):
+    def setUp(self):
+        rows, _ = synthetic.generate(300, seed=3)
+        rows = [list(row) for row in rows]
+        rows[sheet.FIELD_ROW - 3] = [""] * 6 + [str(START_ROW)]
+        for row in rows[sheet.FIELD_ROW:]:
+            for account in synthetic.ACCOUNTS:
+                column = synthetic.FIELDS.index(account)
+                row.extend([""] * (column + 2 - len(row)))
+                row[column + 1] = sheet.RUNNING_FORMULA
+        # Transfers from checking to savings have an amount in both
+        for row in rows[sheet.FIELD_ROW::TRANSFER_EVERY]:
+            checking = synthetic.FIELDS.index("Checking")
+            if row[checking] != "":
+                row[checking + 2] = str(-_get_number(row[checking]))
+        self.sheet = FakeSheet(rows)
+
+        for name in ("get_range", "batch_update_cells", "append_cells"):
+            self._patch(sheets_api, name, getattr(self.sheet, name))
+        self._patch(sheet, "INCREMENTAL_READS", False)
+        for name in ("_entries", "_entry_accounts", "_start_row", "_refresh"):
+            self._patch(sheet, name, None)
+        sheets_api.discard()
+        self.addCleanup(sheets_api.discard)
+
+        self.fields = sheet.get_fields()
+        self.accounts = sheet.get_accounts()
+
+    def _patch(self, module, name, value):
+        self.addCleanup(setattr, module, name, getattr(module, name))
+        setattr(module, name, value)
+
+    def _get_wrong(self):
+        entries = sheet.get_entries(self.fields, self.accounts)
+        return sheet.check_running(entries, self.accounts)
+
+    def _migrate(self):
+        self.assertEqual(self._get_wrong(), [])
+        sheet.migrate_running(self.fields, self.accounts)
+        sheets_api.flush()
+
+    def test_migrate(self):
+        self._migrate()
+        self.assertEqual(self._get_wrong(), [])
+        self.assertFalse(
+            any(
+                "INDIRECT" in value
+                for row in self.sheet.rows[START_ROW - 1:]
+                for value in row
+            )
+        )
+
+    def test_update_and_append(self):
+        self._migrate()
+        rand = random.Random(1)
+        for _ in range(30):
+            entries = sheet.get_entries(self.fields, self.accounts)
+            for _ in range(rand.randint(0, 4)):
+                bank_entry = {
+                    "Date": datetime.datetime(2001, 1, 1),
+                    "Description": "POS PURCHASE",
+                    "Amount": round(rand.uniform(-50, 50), 2),
+                    "Balance": "",
+                    "account": rand.choice(self.accounts),
+                    "Transaction Status": "Posted transaction",
+                }
+                entry_num = rand.choice((None, None, rand.randrange(len(entries))))
+                sheet.update_entry(entry_num, bank_entry, self.fields, self.accounts)
+            sheets_api.flush()
+            self.assertEqual(self._get_wrong(), [])
+
+    def test_wrong_balance_found(self):
+        self._migrate()
+        row = self.sheet.rows[100]
+        checking = synthetic.FIELDS.index("Checking")
+        row[checking] = "1"
+        row[checking + 1] = "=IF(ISBLANK(B101), \"\", B101)"
+        self.assertIn(100 - sheet.FIELD_ROW, self._get_wrong())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+"""Check requests to the Sheets API are retried, against a local fake server."""
+import http.server
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import sheets_api
+
+try:
+    import httplib2
+    from googleapiclient.discovery_cache import get_static_doc
+except ImportError:
+    httplib2 = None
+
+TIMEOUT = 0.5  # Seconds the fake server's slow responses take longer than
+VALUES = [["Date", "Checking"]]  # Values of every range the fake server returns
+
+
+class FakeServer(http.server.ThreadingHTTPServer):
+    """A server answering requests in turn with the given statuses.
+
+    None makes a request time out, and a successful response is sent once the
+    statuses run out. The paths of the requests are kept.
+    """
+
+    def __init__(self, statuses):
+        super().__init__(("127.0.0.1", 0), FakeHandler)
+        self.statuses = list(statuses)
+        self.paths = []
+
+
+class FakeHandler(http.server.BaseHTTPRequestHandler):
+    def _respond(self):
+        self.server.paths.append(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        if status is None:
+            time.sleep(TIMEOUT * 2)
+            status = 200
+        body = json.dumps({"values": VALUES} if status == 200 else {}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+class RetryDelayTest(unittest.TestCase):
+    @unittest.skipIf(httplib2 is None, "httplib2 isn't installed")
+    def test_connection_errors(self):
+        for error in (
+            socket.timeout(),
+            ConnectionResetError(),
+            httplib2.ServerNotFoundError(),
+        ):
+            self.assertIsNotNone(sheets_api._get_retry_delay(error, 0, True))
+            self.assertIsNone(sheets_api._get_retry_delay(error, 0, False))
+
+    def test_other_errors(self):
+        self.assertIsNone(sheets_api._get_retry_delay(ValueError(), 0, True))
+
+
+@unittest.skipIf(httplib2 is None, "googleapiclient isn't installed")
+class FakeServerTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        discovery_file = os.path.join(directory.name, "discovery.json")
+        with open(discovery_file, "w") as document:
+            document.write(get_static_doc("sheets", "v4"))
+
+        for name, value in (
+            ("DISCOVERY_FILE", discovery_file),
+            ("RETRY_DELAY", 0.01),
+            ("BURST_REQUESTS", 100),
+            ("service", None),
+            ("SPREADSHEET_ID", None),
+            ("_authorize_http", None),
+        ):
+            self.addCleanup(setattr, sheets_api, name, getattr(sheets_api, name))
+            setattr(sheets_api, name, value)
+
+    def _connect(self, statuses):
+        server = FakeServer(statuses)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        sheets_api.connect(
+            lambda: httplib2.Http(timeout=TIMEOUT),
+            "spreadsheet",
+            api_root=f"http://127.0.0.1:{server.server_port}/",
+        )
+        return server
+
+    def test_retried(self):
+        server = self._connect([None, 503])
+        self.assertEqual(sheets_api.get_range("Sheet1!A1:B1"), VALUES)
+        self.assertEqual(len(server.paths), 3)
+        self.assertTrue(server.paths[0].startswith("/v4/spreadsheets/spreadsheet/"))
+
+    def test_append_not_retried(self):
+        server = self._connect([503])
+        with self.assertRaises(Exception):
+            sheets_api.append_cells("Sheet1!A9", [["1"]])
+        self.assertEqual(len(server.paths), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()